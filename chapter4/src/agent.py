@@ -1,20 +1,51 @@
-# operator: リストの追加などの演算子を提供（Annotatedで使用）
-import operator
+# asyncio: 非同期処理（OpenAI APIの並行呼び出し）に使用
+import asyncio
+# contextlib: 実行ごとにチェックポインターを開いて閉じるのに使用
+import contextlib
+# contextvars: ノードごとの実行時間・トークン数の記録先を実行ごとに切り替えるのに使用
+import contextvars
+# functools: ノードの計測用デコレーターで元の関数の情報を引き継ぐのに使用
+import functools
+# hashlib: レスポンスキャッシュのキー（メッセージのハッシュ値）の計算に使用
+import hashlib
+# json: キャッシュキー計算のためにメッセージを文字列化するのに使用
+import json
+# string: プロンプトテンプレートの事前解析に使用
+import string
+# time: ノードの実行時間の計測に使用
+import time
+# weakref: 同じ質問の実行を順番に行うためのロックを、使われている間だけ保持するのに使用
+import weakref
 # typing: 型ヒントのための型定義をインポート
-from typing import Annotated, Literal, Sequence, TypedDict
-
+from typing import Annotated, Any, AsyncIterator, Callable, Literal, Sequence, TypedDict
+
+# httpx: OpenAIクライアントが内部で使用するHTTPクライアント（接続プールの設定に使用）
+import httpx
+# tiktoken: 対話履歴のトークン数を数えるのに使用
+import tiktoken
+# LangGraphのノードに渡される実行時の設定の型
+from langchain_core.runnables import RunnableConfig
 # LangChainのツール定義をOpenAI形式に変換するユーティリティ
 from langchain_core.utils.function_calling import convert_to_openai_tool
+# グラフの途中経過（チェックポイント）を保存するためのクラス
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 # LangGraphの並列処理のためのSend関数
 from langgraph.constants import Send
 # LangGraphのグラフ構築のための基本コンポーネント
 from langgraph.graph import END, START, StateGraph
 # LangGraphのコンパイル済みグラフの型
 from langgraph.pregel import Pregel
-# OpenAI APIクライアント
-from openai import OpenAI
+# OpenAI APIの非同期クライアント
+# 並列実行されるサブタスク同士がネットワーク待ちの間にブロックし合わないよう非同期版を使用
+from openai import AsyncOpenAI
+# OpenAIのチャット補完レスポンスの型定義
+from openai.types.chat import ChatCompletion
 # OpenAIのチャット補完メッセージの型定義
 from openai.types.chat import ChatCompletionMessageParam
+# Batch APIの結果をToolPlanクラスとして検証するのに使用
+from pydantic import BaseModel, ValidationError
 
 # アプリケーション設定（APIキーなど）
 from src.configs import Settings
@@ -23,10 +54,13 @@ from src.custom_logger import setup_logger
 # データモデル（計画、サブタスク、検索結果など）
 from src.models import (
     AgentResult,
+    NodeTrace,
     Plan,
     ReflectionResult,
     SearchOutput,
     Subtask,
+    SubtaskPlan,
+    ToolPlan,
     ToolResult,
 )
 # プロンプトテンプレート
@@ -34,10 +68,270 @@ from src.prompts import HelpDeskAgentPrompts
 
 # サブタスクの最大リトライ回数（3回まで再試行）
 MAX_CHALLENGE_COUNT = 3
+# 内省で確認できないまま最大リトライ回数に達したサブタスク回答の先頭に付ける目印
+# （最終回答の作成時に、検証済みの回答と区別できるようにする。create_last_answer_system_promptで説明している）
+UNVERIFIED_ANSWER_PREFIX = "【未検証】"
+
+# レスポンスキャッシュに保持するレスポンスの最大数（超えた場合は最も長く使われていないものから削除）
+RESPONSE_CACHE_MAXSIZE = 256
 
 # このモジュール用のロガーを初期化
 logger = setup_logger(__file__)
 
+# 実行中のエージェントの計測結果（ノードごとの実行時間とトークン数）の記録先
+# arun_agentの呼び出しごとに新しいリストを設定するため、複数の質問を並行して実行しても混ざらない
+_run_trace: contextvars.ContextVar[list[NodeTrace] | None] = contextvars.ContextVar("run_trace", default=None)
+# 実行中のノードの計測結果（OpenAI APIのトークン数をここに加算する）
+_node_trace: contextvars.ContextVar[NodeTrace | None] = contextvars.ContextVar("node_trace", default=None)
+
+
+def _timed(name: str) -> Callable:
+    """
+    ノードの実行時間とOpenAI APIのトークン数を計測するデコレーター
+
+    計測結果はNodeTraceとして実行中のエージェントの記録先に追加され、AgentResult.traceで確認できる。
+    どのノードが実行時間やコストの大半を占めているかを調べるために使う。
+    arun_agentの外から（ノート等で）ノードを直接呼び出した場合は記録しない。
+
+    Args:
+        name (str): 記録するノードの名前
+
+    Returns:
+        Callable: 非同期のノードメソッドを包むデコレーター
+    """
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            trace = NodeTrace(node=name, elapsed_ns=0)
+            token = _node_trace.set(trace)
+            start = time.perf_counter_ns()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                trace.elapsed_ns = time.perf_counter_ns() - start
+                _node_trace.reset(token)
+                run_trace = _run_trace.get()
+                if run_trace is not None:
+                    run_trace.append(trace)
+                logger.debug(
+                    f"⏱️ {name}: {trace.elapsed_ns / 1e6:.1f}ms "
+                    f"(入力 {trace.prompt_tokens} / 出力 {trace.completion_tokens} トークン)"
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def _record_usage(usage: Any) -> None:
+    """
+    OpenAI APIのトークン使用量を実行中のノードの計測結果に加算する
+
+    Args:
+        usage (Any): レスポンスのusage（CompletionUsage。含まれない場合はNone）
+    """
+    trace = _node_trace.get()
+    if trace is None or usage is None:
+        return
+    trace.prompt_tokens += usage.prompt_tokens
+    trace.completion_tokens += usage.completion_tokens
+
+
+def _cache_key(model: str, messages: list, response_format: type | None = None) -> str:
+    """
+    OpenAI APIへのリクエスト内容からレスポンスキャッシュのキーを作成する
+
+    temperature=0, seed=0で呼び出しているため、(モデル, メッセージ, 出力形式)が同じなら
+    同じ応答が返ってくるとみなし、その組み合わせのハッシュ値をキーとする。
+
+    Args:
+        model (str): 使用するモデル名
+        messages (list): OpenAI APIに送信するメッセージのリスト
+        response_format (type | None): Structured Outputsで指定する出力形式のクラス
+
+    Returns:
+        str: キャッシュキー（16バイトのハッシュ値の16進数表現）
+    """
+    payload = json.dumps(
+        {
+            "m": model,
+            "msgs": messages,
+            "rf": response_format.__name__ if response_format else None,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,  # JSONに変換できない値は文字列として扱う
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def _strict_json_schema(schema: Any) -> Any:
+    """
+    PydanticのJSONスキーマを、Structured Outputs（strict）で使える形に変換する
+
+    Structured Outputsでは、全てのオブジェクトでadditionalProperties: falseを指定する必要がある。
+
+    Args:
+        schema (Any): model_json_schema()で作成したJSONスキーマ（またはその一部）
+
+    Returns:
+        Any: 変換後のJSONスキーマ
+    """
+    if isinstance(schema, dict):
+        schema = {key: _strict_json_schema(value) for key, value in schema.items()}
+        if schema.get("type") == "object":
+            schema["additionalProperties"] = False
+        return schema
+    if isinstance(schema, list):
+        return [_strict_json_schema(value) for value in schema]
+    return schema
+
+
+def _response_format_param(response_format: type[BaseModel]) -> dict:
+    """
+    Batch APIのリクエストに指定するStructured Outputsの出力形式を作成する
+
+    Args:
+        response_format (type[BaseModel]): 出力形式のクラス
+
+    Returns:
+        dict: チャット補完リクエストのresponse_formatに指定する値
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_format.__name__,
+            "schema": _strict_json_schema(response_format.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str) -> tiktoken.Encoding | None:
+    """
+    対話履歴のトークン数を数えるためのエンコーディングを取得する
+
+    エンコーディングのファイルは初回使用時にダウンロードされるため、エージェントの作成時ではなく
+    トークン数を初めて数える時に読み込み、以降は同じものを使い回す。
+
+    Args:
+        model (str): 使用するモデル名
+
+    Returns:
+        tiktoken.Encoding | None: エンコーディング（読み込めなかった場合はNone）
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # tiktokenが知らないモデル名（Azureのデプロイメント名など）の場合はgpt-4o系のエンコーディングを使用
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # オフライン環境などでダウンロードできない場合は、文字数でトークン数を見積もる
+        logger.warning(f"トークン数を数えるためのエンコーディングを読み込めませんでした: {e}")
+        return None
+
+
+def _compile_template(template: str) -> Callable[..., str]:
+    """
+    str.format形式のプロンプトテンプレートを事前に解析し、埋め込み用の関数を作成する
+
+    str.formatは呼び出しのたびにテンプレート文字列を解析し直すため、
+    初期化時に一度だけ解析しておき、呼び出し時は値を埋め込んで連結するだけにする。
+
+    Args:
+        template (str): `{question}` のようなプレースホルダーを含むテンプレート
+
+    Returns:
+        Callable[..., str]: キーワード引数で値を受け取り、埋め込み済みの文字列を返す関数
+    """
+    parsed = list(string.Formatter().parse(template))
+
+    # `{a.b}` や `{0}` のような単純な名前以外のプレースホルダーは、str.formatにそのまま任せる
+    if any(field_name is not None and not field_name.isidentifier() for _, field_name, _, _ in parsed):
+        return template.format
+
+    conversions = {"r": repr, "s": str, "a": ascii}
+
+    def render(**kwargs: Any) -> str:
+        parts = []
+        for literal_text, field_name, format_spec, conversion in parsed:
+            parts.append(literal_text)
+            if field_name is not None:
+                value = kwargs[field_name]
+                if conversion:
+                    value = conversions[conversion](value)
+                parts.append(format(value, format_spec or ""))
+        return "".join(parts)
+
+    return render
+
+
+def _format_plan(plan: list[str]) -> str:
+    """
+    計画（サブタスクのリスト）をプロンプト埋め込み用の番号付きテキストに変換する
+
+    `['...', '...']` のようなリストの文字列表現よりも記号が少なく、トークン数を節約できる。
+
+    Args:
+        plan (list[str]): サブタスクのリスト
+
+    Returns:
+        str: 「1. サブタスク」形式で改行区切りにしたテキスト
+    """
+    return "\n".join(f"{i + 1}. {subtask}" for i, subtask in enumerate(plan))
+
+
+def _serialize_search_outputs(
+    outputs: Sequence[SearchOutput], per_hit_char_limit: int = 800, max_hits: int = 5
+) -> str:
+    """
+    検索結果をメッセージ履歴に載せるための文字列に変換する
+
+    検索結果は関連度の高い順に並んでいるため、先頭のmax_hits件だけを残し、
+    各件の本文はper_hit_char_limit文字までに切り詰める（切り詰めた場合は末尾に印を付ける）。
+    メッセージ履歴はサブタスク回答・内省・リトライで毎回送信されるため、ここで小さくしておくと入力トークンを削減できる。
+
+    Args:
+        outputs (Sequence[SearchOutput]): ツールが返した検索結果
+        per_hit_char_limit (int): 1件あたりの本文の最大文字数
+        max_hits (int): 残す検索結果の最大件数
+
+    Returns:
+        str: 検索結果のJSON文字列
+    """
+    hits = []
+    for output in outputs[:max_hits]:
+        content = output.content
+        if len(content) > per_hit_char_limit:
+            content = content[:per_hit_char_limit] + "…[truncated]"
+        hits.append({"file_name": output.file_name, "content": content})
+    return json.dumps(hits, ensure_ascii=False)
+
+
+def _concat_results(current: Sequence[Any], new: Sequence[Any]) -> Sequence[Any]:
+    """
+    状態のリストに新しい結果を追加するreducer
+
+    operator.addと同じく新しいリストを返すが、どちらかが空の場合はコピーせずにそのまま返す。
+    LangGraphはチェックポイントの保存をバックグラウンドで行い、保存中のチェックポイントと
+    状態のリストを共有しているため、list.extendで既存のリストを書き換えることはしない。
+
+    Args:
+        current (Sequence[Any]): 状態に蓄積済みの結果
+        new (Sequence[Any]): ノードが返した新しい結果
+
+    Returns:
+        Sequence[Any]: 結合した結果
+    """
+    if not new:
+        return current
+    if not current:
+        return new
+    return [*current, *new]
+
 
 # メイングラフの状態を管理するクラス
 # エージェント全体の状態（質問、計画、サブタスク結果など）を保持
@@ -46,12 +340,14 @@ class AgentState(TypedDict):
     question: str
     # 生成された実行計画（サブタスクのリスト）
     plan: list[str]
+    # 計画作成時にサブタスクごとに選ばれたツールと引数
+    subtask_plans: list[SubtaskPlan]
     # 現在実行中のサブタスクのステップ番号（0から始まる）
     current_step: int
     # サブタスクの実行結果を蓄積するリスト
-    # Annotated[Sequence[Subtask], operator.add]により、
+    # Annotated[Sequence[Subtask], _concat_results]により、
     # 各ノードからの結果が自動的にリストに追加される
-    subtask_results: Annotated[Sequence[Subtask], operator.add]
+    subtask_results: Annotated[Sequence[Subtask], _concat_results]
     # 最終的な回答（全サブタスクの結果を統合したもの）
     last_answer: str
 
@@ -65,6 +361,8 @@ class AgentSubGraphState(TypedDict):
     plan: list[str]
     # 現在実行中のサブタスク（例: "エラーコードERR-404を検索する"）
     subtask: str
+    # 計画作成時に選ばれたツールと引数（初回のツール選択で使用。ない場合はNone）
+    subtask_plan: SubtaskPlan | None
     # サブタスクが完了したかどうかのフラグ
     # Trueになるとサブグラフのループを終了
     is_completed: bool
@@ -74,10 +372,10 @@ class AgentSubGraphState(TypedDict):
     # 現在のリトライ回数（最大MAX_CHALLENGE_COUNT回まで再試行）
     challenge_count: int
     # ツール実行結果のリスト（各リトライで取得した検索結果を蓄積）
-    # Annotated[Sequence[...], operator.add]により自動的に追加される
-    tool_results: Annotated[Sequence[Sequence[SearchOutput]], operator.add]
+    # Annotated[Sequence[...], _concat_results]により自動的に追加される
+    tool_results: Annotated[Sequence[Sequence[SearchOutput]], _concat_results]
     # 内省（reflection）の結果のリスト（各リトライでの評価結果を蓄積）
-    reflection_results: Annotated[Sequence[ReflectionResult], operator.add]
+    reflection_results: Annotated[Sequence[ReflectionResult], _concat_results]
     # サブタスクに対する回答（検索結果をもとに生成）
     subtask_answer: str
 
@@ -119,23 +417,374 @@ class HelpDeskAgent:
         self.tools = tools
         # ツール名からツールオブジェクトへのマッピング（高速アクセス用）
         self.tool_map = {tool.name: tool for tool in tools}
+        # LangChainのツール定義をOpenAI Function Calling形式に変換しておく
+        # ツールは初期化後に変わらないため、select_toolsの呼び出しごとに変換し直す必要はない
+        self.openai_tools = [convert_to_openai_tool(tool) for tool in tools]
+        # ツール名からOpenAI形式のツール定義へのマッピング（サブタスクごとにツールを絞り込む際に使用）
+        self._openai_tool_by_name = {tool["function"]["name"]: tool for tool in self.openai_tools}
         # プロンプトテンプレートを保存
         self.prompts = prompts
+        # 値を埋め込むユーザープロンプトのテンプレートは、初期化時に一度だけ解析しておく
+        self._render_planner_user_prompt = _compile_template(prompts.planner_user_prompt)
+        self._render_subtask_tool_selection_user_prompt = _compile_template(
+            prompts.subtask_tool_selection_user_prompt
+        )
+        self._render_create_last_answer_user_prompt = _compile_template(prompts.create_last_answer_user_prompt)
+        # 計画作成時に各サブタスクのツールと引数も選べるよう、利用可能なツールの一覧をシステムプロンプトに加えておく
+        tool_descriptions = "\n".join(
+            f"- {t['function']['name']}: {t['function']['description']}"
+            f" 引数: {json.dumps(t['function']['parameters'].get('properties', {}), ensure_ascii=False)}"
+            for t in self.openai_tools
+        )
+        self._planner_system_prompt = f"{prompts.planner_system_prompt}\n# 利用可能なツール\n{tool_descriptions}\n"
         
-        # OpenAI APIクライアントを初期化
+        # OpenAI APIとの通信に使うHTTPクライアントを1つだけ作成し、全てのAPI呼び出しで共有する
+        # 接続プールを使い回すことで、呼び出しごとのTCP/TLSハンドシェイクを省略できる
+        # HTTP/2を有効にすると、並列実行中のサブタスクが1本の接続上でリクエストを多重化できる
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=httpx.Timeout(60.0, connect=5.0),  # 接続確立は短めに打ち切り、リトライに回す
+        )
+
+        # OpenAI APIの非同期クライアントを初期化
         # Azure OpenAIの設定がある場合はAzure OpenAIを使用、なければ通常のOpenAIを使用
+        # max_retries: レート制限（429）やサーバーエラー（5xx）、タイムアウトなど一時的なエラーの場合に、
+        # SDKがRetry-Afterヘッダーや指数バックオフに従って自動で再試行する回数
+        # （一時的なエラーでエージェント全体の実行が中断され、それまでの結果が失われるのを防ぐ）
         if self.settings.azure_openai_api_key:
             # Azure OpenAI用の初期化
-            self.client = OpenAI(
+            self.client = AsyncOpenAI(
                 api_key=self.settings.azure_openai_api_key,
                 base_url=f"{self.settings.azure_openai_endpoint}/openai/deployments/{self.settings.azure_openai_deployment_name}",
                 default_query={"api-version": self.settings.azure_openai_api_version},
+                http_client=self.http_client,
+                max_retries=self.settings.openai_max_retries,
             )
         else:
             # 通常のOpenAI用の初期化
-            self.client = OpenAI(api_key=self.settings.openai_api_key)
+            self.client = AsyncOpenAI(
+                api_key=self.settings.openai_api_key,
+                http_client=self.http_client,
+                max_retries=self.settings.openai_max_retries,
+            )
+
+        # run_agent（同期版）で使い回すイベントループ（初回呼び出し時に作成）
+        self._runner: asyncio.Runner | None = None
+
+        # settings.checkpoint_dbが未設定の場合に、グラフの途中経過を保存するメモリ上のチェックポインター
+        self._memory_saver = MemorySaver()
+        # 質問ごとのロック（同じ質問を並行して実行した場合に、同じスレッドを同時に使わないようにする）
+        self._thread_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        # 質問ごとに、次の実行で最初に確認するスレッドの番号（完了済みのスレッドを毎回確認し直さないようにする）
+        self._thread_generations: dict[str, int] = {}
+
+        # OpenAI APIのレスポンスキャッシュ（キャッシュキー → レスポンス）
+        # 同じ質問や同じサブタスクが繰り返された場合に、APIを呼ばずに前回の結果を再利用する
+        # エージェントを使い回しても際限なく増えないよう、RESPONSE_CACHE_MAXSIZE件までに制限する
+        self._response_cache: dict[str, Any] = {}
+
+    async def aclose(self) -> None:
+        """
+        共有しているHTTPクライアントの接続プールを閉じる
 
-    def create_plan(self, state: AgentState) -> dict:
+        エージェントを使い終わったら `await agent.aclose()` で呼び出す。
+        """
+        await self.http_client.aclose()
+
+    @contextlib.asynccontextmanager
+    async def _open_checkpointer(self) -> AsyncIterator[BaseCheckpointSaver]:
+        """
+        チェックポインターを開く（内部メソッド）
+
+        settings.checkpoint_dbが設定されている場合はSQLiteファイルに保存し、プロセスを再起動しても途中から再開できる。
+        SQLiteへの接続は実行ごとに開き、実行が終わったら閉じる。
+        未設定の場合は、エージェントの全ての実行で共有するメモリ上のチェックポインターを使う。
+
+        Yields:
+            BaseCheckpointSaver: グラフの途中経過を保存するチェックポインター
+        """
+        if self.settings.checkpoint_db:
+            async with AsyncSqliteSaver.from_conn_string(self.settings.checkpoint_db) as checkpointer:
+                yield checkpointer
+        else:
+            yield self._memory_saver
+
+    def _get_cached_response(self, key: str) -> Any | None:
+        """
+        レスポンスキャッシュからレスポンスを取得する（内部メソッド）
+
+        ヒットしたレスポンスは最近使われたものとして末尾に移動する。
+
+        Args:
+            key (str): キャッシュキー
+
+        Returns:
+            Any | None: キャッシュ済みのレスポンス（ない場合はNone）
+        """
+        response = self._response_cache.pop(key, None)
+        if response is not None:
+            self._response_cache[key] = response
+        return response
+
+    def _store_response(self, key: str, response: Any) -> None:
+        """
+        レスポンスをレスポンスキャッシュに保存する（内部メソッド）
+
+        上限に達した場合は、最も長く使われていないレスポンスから削除する。
+
+        Args:
+            key (str): キャッシュキー
+            response (Any): 保存するレスポンス
+        """
+        self._response_cache.pop(key, None)
+        while len(self._response_cache) >= RESPONSE_CACHE_MAXSIZE:
+            self._response_cache.pop(next(iter(self._response_cache)))
+        self._response_cache[key] = response
+
+    async def _find_thread(self, app: Pregel, question_hash: str) -> tuple[RunnableConfig, bool]:
+        """
+        質問の今回の実行に使うスレッドを探す（内部メソッド）
+
+        同じ質問でも実行ごとに「質問のハッシュ値-番号」の別のスレッドを使い、完了した実行の状態を引き継がない。
+        番号の小さい順にスレッドの状態を確認し、途中で失敗したスレッドがあればそれを、
+        なければまだ使われていないスレッドを返す。
+
+        Args:
+            app (Pregel): チェックポインターを設定したメイングラフ
+            question_hash (str): 質問のハッシュ値
+
+        Returns:
+            tuple[RunnableConfig, bool]: スレッドを指定した実行時の設定と、前回の実行を再開するかどうか
+        """
+        generation = self._thread_generations.get(question_hash, 0)
+        while True:
+            config: RunnableConfig = {"configurable": {"thread_id": f"{question_hash}-{generation}"}}
+            snapshot = await app.aget_state(config)
+            if not snapshot.values:
+                # まだ使われていないスレッド：最初から実行する
+                return config, False
+            if snapshot.next:
+                # 途中で失敗したスレッド：完了済みのノードの続きから再開する
+                return config, True
+            # 最後まで完了したスレッド：次の番号のスレッドを確認する
+            generation += 1
+            self._thread_generations[question_hash] = generation
+
+    async def _cached_chat_completion(
+        self,
+        messages: list,
+        response_format: type | None = None,
+        model: str | None = None,
+    ) -> Any:
+        """
+        レスポンスキャッシュを確認してからOpenAI APIにリクエストを送信する（内部メソッド）
+
+        キャッシュにヒットした場合はAPIを呼ばずに前回のレスポンスを返す。
+        response_formatを指定した場合はStructured Outputs（parse）、
+        指定しない場合は通常のチャット補完（create）を使用する。
+
+        Args:
+            messages (list): OpenAI APIに送信するメッセージのリスト
+            response_format (type | None): Structured Outputsで指定する出力形式のクラス
+            model (str | None): 使用するモデル名（省略時はsettings.openai_model）
+
+        Returns:
+            Any: OpenAI APIのレスポンス
+        """
+        model = model or self.settings.openai_model
+        key = _cache_key(model, messages, response_format)
+
+        # キャッシュにヒットした場合はそのまま返す
+        if (cached := self._get_cached_response(key)) is not None:
+            logger.info("♻️ キャッシュ済みのレスポンスを使用します")
+            return cached
+
+        if response_format is None:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,  # 決定的な出力
+                seed=0,  # 再現性のためのシード値
+            )
+        else:
+            response = await self.client.beta.chat.completions.parse(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                temperature=0,
+                seed=0,
+            )
+
+        # 次回以降のためにレスポンスをキャッシュに保存
+        self._store_response(key, response)
+        _record_usage(response.usage)
+        return response
+
+    async def _stream_chat_completion(self, messages: list, token_queue: asyncio.Queue) -> str:
+        """
+        OpenAI APIからストリーミングで応答を受け取り、届いたトークンを順次キューに入れる（内部メソッド）
+
+        レスポンスキャッシュにヒットした場合は、キャッシュ済みの応答をまとめて1回でキューに入れる。
+        ストリーミングで受け取った応答も、結合したものをキャッシュに保存する。
+
+        Args:
+            messages (list): OpenAI APIに送信するメッセージのリスト
+            token_queue (asyncio.Queue): 受け取ったトークンを入れるキュー
+
+        Returns:
+            str: 応答の全文
+        """
+        model = self.settings.openai_model
+        key = _cache_key(model, messages)
+
+        # キャッシュにヒットした場合はそのまま返す
+        if (cached := self._get_cached_response(key)) is not None:
+            logger.info("♻️ キャッシュ済みのレスポンスを使用します")
+            content = cached.choices[0].message.content
+            await token_queue.put(content)
+            return content
+
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0,  # 決定的な出力
+            seed=0,  # 再現性のためのシード値
+            stream=True,  # 生成されたトークンから順に受け取る
+            stream_options={"include_usage": True},  # 最後のチャンクでトークン使用量を受け取る
+        )
+        tokens = []
+        last_chunk = None
+        async for chunk in stream:
+            last_chunk = chunk
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                tokens.append(token)
+                await token_queue.put(token)
+        content = "".join(tokens)
+
+        # 通常のレスポンスと同じ形にしてキャッシュに保存
+        if last_chunk is not None:
+            _record_usage(last_chunk.usage)
+            completion = ChatCompletion.model_validate(
+                {
+                    "id": last_chunk.id,
+                    "object": "chat.completion",
+                    "created": last_chunk.created,
+                    "model": last_chunk.model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": content},
+                        }
+                    ],
+                }
+            )
+            self._store_response(key, completion)
+        return content
+
+    def _count_message_tokens(self, messages: list) -> int:
+        """
+        対話履歴のおおよそのトークン数を数える（内部メソッド）
+
+        各メッセージのcontentと、ツール呼び出し（tool_calls）のJSONをトークン化して合計する。
+
+        Args:
+            messages (list): 対話履歴
+
+        Returns:
+            int: トークン数
+        """
+        encoding = _get_encoding(self.settings.openai_model)
+        # エンコーディングを読み込めなかった場合は、文字数をトークン数とみなす（多めに見積もる）
+        count = len if encoding is None else lambda text: len(encoding.encode(text))
+        total = 0
+        for message in messages:
+            total += count(str(message.get("content") or ""))
+            if "tool_calls" in message:
+                tool_calls = json.dumps(message["tool_calls"], ensure_ascii=False, default=str)
+                total += count(tool_calls)
+        return total
+
+    async def _compress_messages(self, messages: list) -> list:
+        """
+        対話履歴が長くなりすぎた場合に、古い部分を要約して圧縮する（内部メソッド）
+
+        リトライを重ねると、ツール呼び出し・検索結果・回答・内省結果が対話履歴に積み上がり、
+        以降のAPI呼び出しが遅く高価になる。トークン数がsettings.max_history_tokensを超えた場合、
+        先頭のシステムプロンプトと直近のメッセージはそのまま残し、その間を1つの要約メッセージに置き換える。
+
+        Args:
+            messages (list): 対話履歴
+
+        Returns:
+            list: 圧縮後の対話履歴（上限以内ならそのまま返す）
+        """
+        if self._count_message_tokens(messages) <= self.settings.max_history_tokens:
+            return messages
+
+        # 先頭のシステムプロンプトは常に残す
+        head, body = messages[:1], messages[1:]
+
+        # 直近のメッセージを残す境界を決める
+        # toolメッセージは対応するtool_callsを持つassistantメッセージの直後にある必要があるため、
+        # 残す部分がtoolメッセージから始まらないよう境界を前にずらす
+        split = max(len(body) - self.settings.history_keep_last_messages, 0)
+        while 0 < split < len(body) and body[split]["role"] == "tool":
+            split -= 1
+        if split == 0:
+            return messages
+        middle, tail = body[:split], body[split:]
+
+        logger.info(f"対話履歴を要約して圧縮します（{len(middle)}件のメッセージ）...")
+        summary_messages = [
+            {"role": "system", "content": self.prompts.history_summary_system_prompt},
+            {"role": "user", "content": json.dumps(middle, ensure_ascii=False, default=str)},
+        ]
+        try:
+            response = await self._cached_chat_completion(
+                messages=summary_messages,
+                model=self.settings.summary_model,  # 要約には安価なモデルを使用
+            )
+        except Exception as e:
+            logger.error(f"OpenAIリクエスト中にエラーが発生しました: {e}")
+            raise
+
+        summary = response.choices[0].message.content
+        return [*head, {"role": "system", "content": f"これまでの対話の要約:\n{summary}"}, *tail]
+
+    def _build_plan_messages(self, question: str) -> list:
+        """
+        計画作成用のメッセージを構築する（内部メソッド）
+
+        create_planとBatch APIによる計画の先行生成で同じメッセージ（＝同じキャッシュキー）を使うために共通化している。
+
+        Args:
+            question (str): ユーザーからの質問
+
+        Returns:
+            list: OpenAI APIに送信するメッセージのリスト
+        """
+        # システムプロンプトを取得
+        # エージェントの役割と計画の作成方法、利用可能なツールを指示
+        system_prompt = self._planner_system_prompt
+
+        # ユーザープロンプトを生成
+        # テンプレートにユーザーの質問を埋め込む
+        user_prompt = self._render_planner_user_prompt(
+            question=question,
+        )
+
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+
+    @_timed("create_plan")
+    async def create_plan(self, state: AgentState) -> dict:
         """
         計画を作成する（メイングラフの最初のステップ）
         
@@ -148,57 +797,47 @@ class HelpDeskAgent:
             state (AgentState): 入力の状態（questionを含む）
 
         Returns:
-            dict: 更新された状態（planを含む）
+            dict: 更新された状態（planとsubtask_plansを含む）
         """
 
         logger.info("🚀 計画生成処理を開始します...")
 
-        # システムプロンプトを取得
-        # エージェントの役割と計画の作成方法を指示
-        system_prompt = self.prompts.planner_system_prompt
-
-        # ユーザープロンプトを生成
-        # テンプレートにユーザーの質問を埋め込む
-        user_prompt = self.prompts.planner_user_prompt.format(
-            question=state["question"],
-        )
-        
         # OpenAI APIに送信するメッセージを構築
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
+        messages = self._build_plan_messages(state["question"])
         logger.debug(f"最終的なプロンプトメッセージ: {messages}")
 
         # OpenAI APIにリクエストを送信
-        # Structured Outputsを使用してPlanクラスの形式で結果を取得
-        # Planの型は以下
-        # class Plan(BaseModel):
-        #   subtasks: list[str] = Field(..., description="問題を解決するためのサブタスクリスト")
+        # Structured Outputsを使用してToolPlanクラスの形式で結果を取得
+        # ToolPlanの型は以下
+        # class ToolPlan(BaseModel):
+        #   subtasks: list[SubtaskPlan] = Field(..., description="問題を解決するためのサブタスクリスト")
+        # SubtaskPlanはサブタスクの内容（name）と、最初に実行するツール（tool_name, tool_args）を持つ
         try:
             logger.info("OpenAIにリクエストを送信中...")
-            response = self.client.beta.chat.completions.parse(
-                model=self.settings.openai_model,  # 使用するモデル（例: gpt-4o）
+            response = await self._cached_chat_completion(
                 messages=messages,  # プロンプト
-                response_format=Plan,  # 出力形式をPlanクラスに指定
-                temperature=0,  # 決定的な出力（常に同じ結果）
-                seed=0,  # 再現性のためのシード値
+                response_format=ToolPlan,  # 出力形式をToolPlanクラスに指定
+                model=self.settings.openai_model_planner,  # 計画作成用のモデル
             )
             logger.info("✅ OpenAIからのレスポンスを正常に受信しました")
         except Exception as e:
             logger.error(f"OpenAIリクエスト中にエラーが発生しました: {e}")
             raise
 
-        # レスポンスからStructured Outputsを利用してPlanクラスのインスタンスを取得
+        # レスポンスからStructured Outputsを利用してToolPlanクラスのインスタンスを取得
         # plan.subtasksには生成されたサブタスクのリストが含まれる
         plan = response.choices[0].message.parsed
 
         logger.info("計画生成が完了しました！")
 
-        # 生成した計画（サブタスクのリスト）を返し、状態を更新する
-        return {"plan": plan.subtasks}
+        # 生成した計画（サブタスクのリスト）とサブタスクごとのツールを返し、状態を更新する
+        return {
+            "plan": [subtask.name for subtask in plan.subtasks],
+            "subtask_plans": plan.subtasks,
+        }
 
-    def select_tools(self, state: AgentSubGraphState) -> dict:
+    @_timed("select_tools")
+    async def select_tools(self, state: AgentSubGraphState) -> dict:
         """
         ツールを選択する（サブグラフの最初のステップ）
         
@@ -209,6 +848,9 @@ class HelpDeskAgent:
         内省（reflection）の結果、再試行が必要な場合は、
         過去の対話履歴を参照して別のツールや別のキーワードを選択する。
 
+        初回実行で、計画作成時に選ばれたツールと引数（subtask_plan）が使える場合は、
+        OpenAI APIを呼ばずにそのツール呼び出しをそのまま使う。
+
         Args:
             state (AgentSubGraphState): 入力の状態
 
@@ -218,20 +860,15 @@ class HelpDeskAgent:
 
         logger.info("🚀 ツール選択処理を開始します...")
 
-        # LangChainのツール定義をOpenAI Function Calling形式に変換
-        # これによりOpenAIのモデルがツールの使い方を理解できる
-        logger.debug("ツールをOpenAI形式に変換中...")
-        openai_tools = [convert_to_openai_tool(tool) for tool in self.tools]
-
         # 初回実行かリトライかでプロンプトを切り替える
         if state["challenge_count"] == 0:
             # === 初回実行の場合 ===
             logger.debug("ツール選択用のユーザープロンプトを作成中...")
             
             # サブタスクに適したツール選択を促すプロンプトを生成
-            user_prompt = self.prompts.subtask_tool_selection_user_prompt.format(
+            user_prompt = self._render_subtask_tool_selection_user_prompt(
                 question=state["question"],  # 元の質問
-                plan=state["plan"],  # 全体の計画
+                plan=_format_plan(state["plan"]),  # 全体の計画（番号付きテキスト）
                 subtask=state["subtask"],  # 現在のサブタスク
             )
 
@@ -241,42 +878,41 @@ class HelpDeskAgent:
                 {"role": "user", "content": user_prompt},
             ]
 
+            # 計画作成時にツールと引数が選ばれている場合は、ツール選択のAPI呼び出しを省略する
+            planned_tool_call = self._planned_tool_call(state)
+            if planned_tool_call is not None:
+                logger.info("計画作成時に選ばれたツールを使用します")
+                return {"messages": [*messages, {"role": "assistant", "tool_calls": [planned_tool_call]}]}
+
         else:
             # === リトライの場合 ===
             logger.debug("リトライ用のユーザープロンプトを作成中...")
 
             # 過去の対話履歴を取得
             # 前回の試行でのツール選択、検索結果、内省結果などが含まれる
-            messages: list = state["messages"]
-                        
-                        
-            # NOTE: トークン数節約のため、過去の検索結果（長文）は除外
-            # roleが"tool"のメッセージ（検索結果）と
-            # "tool_calls"を含むメッセージ（ツール呼び出し）を除外
-            # → なぜこんなことをやっているのか. 以下のファイルにて解説
+            # NOTE: 過去のメッセージは削除・書き換えせず、末尾にリトライ指示を追加するだけにする
+            # OpenAIのプロンプトキャッシュは「前回と完全に一致する先頭部分」にのみ効くため、
+            # 途中のメッセージを除外すると以降のトークンが全て再課金されてしまう
+            # → 以前のフィルタリングについては以下のファイルにて解説
             # markdown(解説)/05_リトライ時のメッセージフィルタリングとトークン削減.md 
-            filtered_messages = []
-            for message in messages:
-                if message["role"] == "tool" and "tool_calls" in message:
-                    # tool_calls を持つツールメッセージなのでスキップ
-                    continue
-                filtered_messages.append(message)
-            messages = filtered_messages
 
             # リトライを促すプロンプトを追加
             # 「前回の結果が不十分だったので、別のツールやキーワードで再試行してください」
             user_retry_prompt = self.prompts.subtask_retry_answer_user_prompt
             user_message = {"role": "user", "content": user_retry_prompt}
-            messages.append(user_message)
+            messages = [*state["messages"], user_message]
+
+        # 対話履歴が長くなりすぎている場合は古い部分を要約して圧縮
+        messages = await self._compress_messages(messages)
 
         # OpenAI APIにリクエストを送信
         # Function Callingを使用してツールを選択
         try:
             logger.info("OpenAIにリクエストを送信中...")
-            response = self.client.chat.completions.create(
-                model=self.settings.openai_model,
+            response = await self.client.chat.completions.create(
+                model=self.settings.openai_model_tool_selection,  # ツール選択用のモデル
                 messages=messages,
-                tools=openai_tools,  # type: ignore  # 利用可能なツールのリスト
+                tools=self._select_openai_tools(state),  # type: ignore  # サブタスクで使うツールのリスト（初期化時に変換済み）
                 temperature=0,  # 決定的な出力
                 seed=0,  # 再現性のためのシード値
             )
@@ -285,6 +921,8 @@ class HelpDeskAgent:
             logger.error(f"OpenAIリクエスト中にエラーが発生しました: {e}")
             raise
 
+        _record_usage(response.usage)
+
         # ツール呼び出しが含まれているか確認
         if response.choices[0].message.tool_calls is None:
             raise ValueError("ツール呼び出しがNullです")
@@ -297,12 +935,80 @@ class HelpDeskAgent:
         }
 
         logger.info("ツール選択が完了しました！")
-        messages.append(ai_message)
 
         # 更新されたメッセージ履歴を返す
-        return {"messages": messages}
+        # NOTE: 状態のリストを書き換えず、新しいリストを作って返す（以降のノードも同様）
+        return {"messages": [*messages, ai_message]}
+
+    def _select_openai_tools(self, state: AgentSubGraphState) -> list[dict]:
+        """
+        ツール選択でOpenAIに送信するツール定義を選ぶ（内部メソッド）
 
-    def execute_tools(self, state: AgentSubGraphState) -> dict:
+        計画作成時にサブタスクで使うツール（allowed_tools）が選ばれている場合は、そのツールだけを送信する。
+        ツール定義はリクエストのたびに入力トークンとして課金されるため、ツールが多いほど効果が大きい。
+        リトライで絞り込んだツールを全て試し終えた場合や、有効なツールが選ばれていない場合は全てのツールを送信する。
+
+        Args:
+            state (AgentSubGraphState): 入力の状態（subtask_planとtool_resultsを含む）
+
+        Returns:
+            list[dict]: OpenAI形式のツール定義のリスト
+        """
+        subtask_plan = state.get("subtask_plan")
+        if subtask_plan is None:
+            return self.openai_tools
+
+        allowed_tools = [name for name in subtask_plan.allowed_tools if name in self._openai_tool_by_name]
+        allowed_tools = list(dict.fromkeys(allowed_tools))[: self.settings.tools_per_subtask]
+        if not allowed_tools:
+            return self.openai_tools
+
+        # これまでの試行で実行済みのツール
+        tried_tools = {result.tool_name for results in state.get("tool_results", []) for result in results}
+        if state["challenge_count"] > 0 and tried_tools.issuperset(allowed_tools):
+            logger.info("絞り込んだツールを全て試したため、全てのツールから選択します")
+            return self.openai_tools
+
+        return [self._openai_tool_by_name[name] for name in allowed_tools]
+
+    def _planned_tool_call(self, state: AgentSubGraphState) -> dict | None:
+        """
+        計画作成時に選ばれたツールと引数からツール呼び出しを作成する（内部メソッド）
+
+        ツールが存在しない、または引数がツールの入力形式に合わない場合はNoneを返し、
+        通常どおりOpenAI APIでツールを選択させる。
+
+        Args:
+            state (AgentSubGraphState): 入力の状態（subtask_planを含む）
+
+        Returns:
+            dict | None: OpenAI形式のツール呼び出し（使えない場合はNone）
+        """
+        subtask_plan = state.get("subtask_plan")
+        if subtask_plan is None or subtask_plan.tool_name not in self.tool_map:
+            return None
+
+        # 引数をツールの入力スキーマで検証する
+        tool = self.tool_map[subtask_plan.tool_name]
+        try:
+            tool_args = json.loads(subtask_plan.tool_args)
+            if tool.args_schema is not None:
+                tool.args_schema.model_validate(tool_args)
+        except ValueError as e:
+            logger.warning(f"計画作成時に選ばれたツールの引数が不正なため、ツールを選択し直します: {e}")
+            return None
+
+        return {
+            "id": "call_plan",  # 対話履歴内でツールの実行結果と対応付けるためのID
+            "type": "function",
+            "function": {
+                "name": subtask_plan.tool_name,
+                "arguments": json.dumps(tool_args, ensure_ascii=False),
+            },
+        }
+
+    @_timed("execute_tools")
+    async def execute_tools(self, state: AgentSubGraphState) -> dict:
         """
         ツールを実行する（サブグラフの2番目のステップ）
         
@@ -310,7 +1016,7 @@ class HelpDeskAgent:
         例：search_xyz_manual(keywords="ERR-404")を実行
         → Elasticsearchで検索してドキュメントを取得
         
-        複数のツールが選択された場合は、順番に実行する。
+        複数のツールが選択された場合は、並行して実行する。
 
         Args:
             state (AgentSubGraphState): 入力の状態（messagesを含む）
@@ -335,23 +1041,44 @@ class HelpDeskAgent:
             logger.error(f"メッセージ: {messages}")
             raise ValueError("ツール呼び出しがNullです")
 
-        # ツール実行結果を格納するリスト
+        # 同じツールを同じ引数で呼び出すtool_callsは1回だけ実行する
+        # （temperature=0のFunction Callingでは同一の呼び出しが重複して出力されることがある）
+        # キーは(ツール名, キーを並べ替えた引数のJSON)で、値は最初に出現したtool_callの引数
+        unique_calls: dict[tuple[str, str], str | dict] = {}
+        call_keys = []
+        for tool_call in tool_calls:
+            tool_name = tool_call["function"]["name"]
+            tool_args = tool_call["function"]["arguments"]
+            parsed_args = tool_args if isinstance(tool_args, dict) else json.loads(tool_args)
+            call_key = (tool_name, json.dumps(parsed_args, sort_keys=True, ensure_ascii=False))
+            unique_calls.setdefault(call_key, tool_args)
+            call_keys.append(call_key)
+        if len(unique_calls) < len(tool_calls):
+            logger.info(f"重複したツール呼び出しを{len(tool_calls) - len(unique_calls)}件省略します")
+
+        # 重複を除いたツール呼び出しを並行して実行
+        # ツール呼び出し同士は互いに独立したI/O（ElasticsearchやQdrantへの検索）なので、
+        # asyncio.gatherでまとめて待つことで、待ち時間を「合計」から「最大値」に短縮できる
+        # 例: search_xyz_manual.ainvoke({"keywords": "ERR-404"})
+        # → ElasticsearchまたはQdrantで検索
+        # NOTE: 同期関数として定義されたツールのainvokeは、内部でスレッドプール上で実行される
+        unique_outputs: list[list[SearchOutput]] = await asyncio.gather(
+            *[self.tool_map[tool_name].ainvoke(tool_args) for (tool_name, _), tool_args in unique_calls.items()]
+        )
+        # gatherは入力と同じ順番で結果を返すため、キーと対応付けて各tool_callに結果を配る
+        output_by_key = dict(zip(unique_calls, unique_outputs, strict=True))
+        tool_outputs = [output_by_key[call_key] for call_key in call_keys]
+
+        # ツール実行結果と、それをメッセージ履歴に追加するためのメッセージを格納するリスト
         tool_results = []
+        tool_messages = []
 
-        # 各ツール呼び出しを順番に実行
-        for tool_call in tool_calls:
+        # gatherは入力と同じ順番で結果を返すため、tool_callsと対応付けて順番に処理する
+        for tool_call, tool_result in zip(tool_calls, tool_outputs, strict=True):
             # ツール名と引数を取得
             tool_name = tool_call["function"]["name"]  # 例: "search_xyz_manual"
             tool_args = tool_call["function"]["arguments"]  # 例: {"keywords": "ERR-404"}
 
-            # ツールマップからツールオブジェクトを取得
-            tool = self.tool_map[tool_name]
-            
-            # ツールを実行して検索結果を取得
-            # 例: search_xyz_manual.invoke({"keywords": "ERR-404"})
-            # → ElasticsearchまたはQdrantで検索
-            tool_result: list[SearchOutput] = tool.invoke(tool_args)
-
             # 実行結果をToolResultオブジェクトにラップして保存
             tool_results.append(
                 ToolResult(
@@ -363,19 +1090,25 @@ class HelpDeskAgent:
 
             # ツール実行結果をメッセージ履歴に追加
             # これによりAIが検索結果を参照して回答を生成できる
-            messages.append(
+            # NOTE: tool_resultsには全件をそのまま保存し、メッセージ履歴には件数と本文の長さを絞ったものだけを載せる
+            tool_messages.append(
                 {
                     "role": "tool",  # ツールからの応答
-                    "content": str(tool_result),  # 検索結果の文字列表現
+                    "content": _serialize_search_outputs(
+                        tool_result,
+                        per_hit_char_limit=self.settings.tool_result_char_limit,
+                        max_hits=self.settings.tool_result_max_hits,
+                    ),  # 検索結果の文字列表現
                     "tool_call_id": tool_call["id"],  # どのツール呼び出しの結果か紐付け
                 }
             )
         logger.info("ツール実行が完了しました！")
         
         # 更新されたメッセージ履歴とツール実行結果を返す
-        return {"messages": messages, "tool_results": [tool_results]}
+        return {"messages": [*messages, *tool_messages], "tool_results": [tool_results]}
 
-    def create_subtask_answer(self, state: AgentSubGraphState) -> dict:
+    @_timed("create_subtask_answer")
+    async def create_subtask_answer(self, state: AgentSubGraphState) -> dict:
         """
         サブタスク回答を作成する（サブグラフの3番目のステップ）
         
@@ -395,7 +1128,9 @@ class HelpDeskAgent:
         """
 
         logger.info("🚀 サブタスク回答作成処理を開始します...")
-        messages = state["messages"]
+
+        # 対話履歴が長くなりすぎている場合は古い部分を要約して圧縮
+        messages = await self._compress_messages(state["messages"])
 
         # OpenAI APIにリクエストを送信
         # messagesには以下が含まれる：
@@ -406,11 +1141,9 @@ class HelpDeskAgent:
         # これらを全てコンテキストとして回答を生成
         try:
             logger.info("OpenAIにリクエストを送信中...")
-            response = self.client.chat.completions.create(
-                model=self.settings.openai_model,
+            response = await self._cached_chat_completion(
                 messages=messages,  # 全ての対話履歴
-                temperature=0,  # 決定的な出力
-                seed=0,  # 再現性のためのシード値
+                model=self.settings.openai_model_subtask_answer,  # サブタスク回答用のモデル
             )
             logger.info("✅ OpenAIからのレスポンスを正常に受信しました")
         except Exception as e:
@@ -422,7 +1155,7 @@ class HelpDeskAgent:
 
         # AIの回答をメッセージ履歴に追加
         ai_message = {"role": "assistant", "content": subtask_answer}
-        messages.append(ai_message)
+        messages = [*messages, ai_message]
 
         logger.info("サブタスク回答作成が完了しました！")
 
@@ -432,7 +1165,8 @@ class HelpDeskAgent:
             "subtask_answer": subtask_answer,
         }
 
-    def reflect_subtask(self, state: AgentSubGraphState) -> dict:
+    @_timed("reflect_subtask")
+    async def reflect_subtask(self, state: AgentSubGraphState) -> dict:
         """
         サブタスク回答を内省する（サブグラフの4番目のステップ）
         
@@ -447,6 +1181,12 @@ class HelpDeskAgent:
         is_completed=Trueの場合、またはMAX_CHALLENGE_COUNT到達時：
         → サブグラフを終了し、次のサブタスクへ進む
 
+        最後の挑戦（この内省の後に再試行できない回）では内省のAPI呼び出しを行わず、
+        最後に作成したサブタスク回答の先頭にUNVERIFIED_ANSWER_PREFIXを付けて使う。
+        内省で確認していない回答のため、is_completedはFalseとする。
+        （以前は最後の内省で不十分と判断された回答を「回答が見つかりませんでした」に置き換えていたが、
+        内省を省略する代わりに、未検証であることを明示して最終回答の作成に渡す）
+
         Args:
             state (AgentSubGraphState): 入力の状態（messagesを含む）
 
@@ -460,23 +1200,41 @@ class HelpDeskAgent:
         logger.info("🚀 内省処理を開始します...")
         messages = state["messages"]
 
+        # 今回が最後の挑戦の場合、内省結果に関わらずサブグラフは終了するため、内省のAPI呼び出しを省略する
+        # 回答は検証されていないため、is_completedはFalseのままにし、回答が未検証であることを明示する
+        if state["challenge_count"] + 1 >= MAX_CHALLENGE_COUNT:
+            logger.info("最大リトライ回数に達したため、内省を省略します")
+            subtask_answer = state.get("subtask_answer")
+            return {
+                "messages": messages,
+                "reflection_results": [],
+                "challenge_count": state["challenge_count"] + 1,
+                "is_completed": False,
+                "subtask_answer": (
+                    f"{UNVERIFIED_ANSWER_PREFIX}{subtask_answer}"
+                    if subtask_answer
+                    else f"{state['subtask']}の回答が見つかりませんでした。"
+                ),
+            }
+
         # 内省を促すプロンプトを取得
         # 「生成した回答は十分ですか？不足している場合は何が必要ですか？」
         user_prompt = self.prompts.subtask_reflection_user_prompt
 
         # 内省プロンプトをメッセージ履歴に追加
-        messages.append({"role": "user", "content": user_prompt})
+        messages = [*messages, {"role": "user", "content": user_prompt}]
+
+        # 対話履歴が長くなりすぎている場合は古い部分を要約して圧縮
+        messages = await self._compress_messages(messages)
 
         # OpenAI APIにリクエストを送信
         # Structured Outputsを使用してReflectionResultクラスの形式で結果を取得
         try:
             logger.info("OpenAIにリクエストを送信中...")
-            response = self.client.beta.chat.completions.parse(
-                model=self.settings.openai_model,
+            response = await self._cached_chat_completion(
                 messages=messages,
                 response_format=ReflectionResult,  # 内省結果の構造を指定
-                temperature=0,
-                seed=0,
+                model=self.settings.openai_model_reflection,  # 内省用のモデル（Structured Outputs対応のものを指定）
             )
             logger.info("✅ OpenAIからのレスポンスを正常に受信しました")
         except Exception as e:
@@ -491,12 +1249,13 @@ class HelpDeskAgent:
             raise ValueError("内省結果がNullです")
 
         # 内省結果をメッセージ履歴に追加
-        messages.append(
+        messages = [
+            *messages,
             {
                 "role": "assistant",
                 "content": reflection_result.model_dump_json(),
-            }
-        )
+            },
+        ]
 
         # 状態を更新
         update_state = {
@@ -506,15 +1265,11 @@ class HelpDeskAgent:
             "is_completed": reflection_result.is_completed,  # 完了フラグを更新
         }
 
-        # 最大リトライ回数に達し、かつ回答が不完全な場合
-        # → これ以上再試行せず、デフォルトの回答を設定
-        if update_state["challenge_count"] >= MAX_CHALLENGE_COUNT and not reflection_result.is_completed:
-            update_state["subtask_answer"] = f"{state['subtask']}の回答が見つかりませんでした。"
-
         logger.info("内省が完了しました！")
         return update_state
 
-    def create_answer(self, state: AgentState) -> dict:
+    @_timed("create_answer")
+    async def create_answer(self, state: AgentState, config: RunnableConfig | None = None) -> dict:
         """
         最終回答を作成する（メイングラフの最後のステップ）
         
@@ -523,9 +1278,13 @@ class HelpDeskAgent:
         - サブタスク1の回答: "ERR-404は、リソースが見つからないエラーです。"
         - サブタスク2の回答: "対処法は、URLを確認するか、管理者に連絡してください。"
         → 最終回答: "ERR-404エラーは...対処法としては...があります。"
+        
+        configの"configurable"に"token_queue"（asyncio.Queue）が指定されている場合は、
+        ストリーミングで回答を生成し、届いたトークンを順次キューに入れる（run_agent_streamで使用）。
 
         Args:
             state (AgentState): 入力の状態（question、plan、subtask_resultsを含む）
+            config (RunnableConfig | None): LangGraphから渡される実行時の設定
 
         Returns:
             dict: 更新された状態（last_answerを含む）
@@ -539,18 +1298,20 @@ class HelpDeskAgent:
 
         # サブタスク結果からタスク内容と回答のみを抽出
         # (ツール実行結果や内省結果などの詳細は除外してトークン数を節約)
-        subtask_results = []
-        for result in state["subtask_results"]:
-            # 各サブタスクから「タスク名」と「回答」を抽出してタプルにする
-            task_info = (result.task_name, result.subtask_answer)
-            subtask_results.append(task_info)
+        # 各サブタスクを {"t": タスク名, "a": 回答} の形にし、区切り文字の空白を省いたJSONにする
+        # （タプルのリストをstr()した場合の括弧やエスケープされた引用符よりもトークン数が少ない）
+        subtask_results = json.dumps(
+            [{"t": result.task_name, "a": result.subtask_answer} for result in state["subtask_results"]],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
         
         # ユーザープロンプトを生成
         # 元の質問、計画、各サブタスクの結果を含める
-        user_prompt = self.prompts.create_last_answer_user_prompt.format(
+        user_prompt = self._render_create_last_answer_user_prompt(
             question=state["question"],  # 元の質問
-            plan=state["plan"],  # 実行計画
-            subtask_results=str(subtask_results),  # 各サブタスクの結果
+            plan=_format_plan(state["plan"]),  # 実行計画
+            subtask_results=subtask_results,  # 各サブタスクの結果（JSON）
         )
         
         # OpenAI APIに送信するメッセージを構築
@@ -559,15 +1320,20 @@ class HelpDeskAgent:
             {"role": "user", "content": user_prompt},
         ]
 
+        # ストリーミング用のキューが指定されているか確認
+        token_queue = (config or {}).get("configurable", {}).get("token_queue")
+
         # OpenAI APIにリクエストを送信
         try:
             logger.info("OpenAIにリクエストを送信中...")
-            response = self.client.chat.completions.create(
-                model=self.settings.openai_model,
-                messages=messages,
-                temperature=0,  # 決定的な出力
-                seed=0,  # 再現性のためのシード値
-            )
+            if token_queue is None:
+                response = await self._cached_chat_completion(
+                    messages=messages,
+                )
+                last_answer = response.choices[0].message.content
+            else:
+                # 生成されたトークンから順に呼び出し元へ渡す
+                last_answer = await self._stream_chat_completion(messages, token_queue)
             logger.info("✅ OpenAIからのレスポンスを正常に受信しました")
         except Exception as e:
             logger.error(f"OpenAIリクエスト中にエラーが発生しました: {e}")
@@ -576,9 +1342,9 @@ class HelpDeskAgent:
         logger.info("最終回答作成が完了しました！")
 
         # 最終回答を返し、状態を更新する
-        return {"last_answer": response.choices[0].message.content}
+        return {"last_answer": last_answer}
 
-    def _execute_subgraph(self, state: AgentState):
+    async def _execute_subgraph(self, state: AgentState):
         """
         サブグラフを実行する（内部メソッド）
         
@@ -601,13 +1367,19 @@ class HelpDeskAgent:
         # サブグラフ（サブワークフロー）を作成
         subgraph = self._create_subgraph()
 
-        # サブグラフを実行
+        # 計画作成時に選ばれたサブタスクごとのツールと引数（古いチェックポイントなどで存在しない場合は空）
+        subtask_plans = state.get("subtask_plans", [])
+
+        # サブグラフを非同期に実行
         # 初期状態を設定してサブタスクの実行を開始
-        result = subgraph.invoke(
+        # awaitでOpenAIの応答を待つ間、並列実行中の他のサブタスクに処理を譲る
+        result = await subgraph.ainvoke(
             {
                 "question": state["question"],  # 元の質問（コンテキスト）
                 "plan": state["plan"],  # 全体の計画（コンテキスト）
                 "subtask": state["plan"][state["current_step"]],  # 現在のサブタスク
+                # 計画作成時に選ばれたツールと引数
+                "subtask_plan": subtask_plans[state["current_step"]] if subtask_plans else None,
                 "current_step": state["current_step"],  # ステップ番号
                 "is_completed": False,  # 初期状態は未完了
                 "challenge_count": 0,  # リトライ回数は0から開始
@@ -651,6 +1423,7 @@ class HelpDeskAgent:
                 {
                     "question": state["question"],  # 元の質問
                     "plan": state["plan"],  # 全体の計画
+                    "subtask_plans": state.get("subtask_plans", []),  # サブタスクごとのツールと引数
                     "current_step": idx,  # サブタスクのインデックス
                 },
             )
@@ -754,7 +1527,7 @@ class HelpDeskAgent:
 
         return app
 
-    def create_graph(self) -> Pregel:
+    def create_graph(self, checkpointer: BaseCheckpointSaver | None = None) -> Pregel:
         """
         エージェントのメイングラフ（全体のワークフロー）を作成する
         
@@ -779,6 +1552,10 @@ class HelpDeskAgent:
             - サブタスク2：対処法を検索
         → 最終回答：2つの結果を統合して回答生成
 
+        Args:
+            checkpointer (BaseCheckpointSaver | None): ノードの実行結果を保存するチェックポインター。
+                指定した場合、途中で失敗した実行を完了済みのノードの続きから再開できる。
+
         Returns:
             Pregel: コンパイル済みのメイングラフ
         """
@@ -818,15 +1595,121 @@ class HelpDeskAgent:
         workflow.set_finish_point("create_answer")
 
         # ワークフローをコンパイルして実行可能な形式に変換
-        app = workflow.compile()
+        app = workflow.compile(checkpointer=checkpointer)
 
         return app
 
-    def run_agent(self, question: str) -> AgentResult:
+    async def _run_batch(self, bodies: dict[str, dict]) -> dict[str, ChatCompletion]:
+        """
+        OpenAIのBatch APIでチャット補完リクエストをまとめて実行する（内部メソッド）
+
+        リクエストをJSONLファイルとしてアップロードし、バッチを作成して完了までポーリングする。
+        Batch APIはリアルタイムのAPIより安価でスループットの上限も高いが、結果が返るまでに時間がかかる。
+
+        Args:
+            bodies (dict[str, dict]): custom_id → チャット補完リクエストのボディ
+
+        Raises:
+            RuntimeError: バッチが正常に完了しなかった場合
+
+        Returns:
+            dict[str, ChatCompletion]: custom_id → レスポンス（失敗したリクエストは含まない）
+        """
+        # リクエストをBatch APIの入力形式（1行1リクエストのJSONL）に変換してアップロード
+        lines = [
+            json.dumps(
+                {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body},
+                ensure_ascii=False,
+            )
+            for custom_id, body in bodies.items()
+        ]
+        batch_file = await self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch",
+        )
+
+        # バッチを作成
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        logger.info(f"バッチ {batch.id} を作成しました（{len(bodies)}件のリクエスト）")
+
+        # バッチが終了するまでポーリング
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(self.settings.batch_poll_interval_seconds)
+            batch = await self.client.batches.retrieve(batch.id)
+            logger.info(f"バッチ {batch.id} の状態: {batch.status}")
+
+        if batch.status != "completed" or batch.output_file_id is None:
+            raise RuntimeError(f"バッチ {batch.id} が完了しませんでした: {batch.status}")
+
+        # 結果ファイルをダウンロードし、custom_idごとにレスポンスを取り出す
+        output = await self.client.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            record = json.loads(line)
+            response = record.get("response")
+            if record.get("error") or response is None or response["status_code"] != 200:
+                logger.warning(f"バッチ内のリクエスト {record['custom_id']} が失敗しました: {record.get('error')}")
+                continue
+            results[record["custom_id"]] = ChatCompletion.model_validate(response["body"])
+
+        return results
+
+    async def _prefetch_plans_with_batch(self, questions: list[str]) -> None:
         """
-        エージェントを実行する（エントリーポイント）
+        複数の質問の計画をBatch APIでまとめて作成し、レスポンスキャッシュに格納する（内部メソッド）
+
+        create_planと同じメッセージ・モデルでリクエストを作成するため、
+        その後のグラフ実行ではcreate_planがキャッシュにヒットし、APIを呼び出さずに済む。
+        失敗したリクエストはキャッシュに入らないため、create_planで通常どおりAPIが呼ばれる。
+
+        Args:
+            questions (list[str]): ユーザーからの質問のリスト
+        """
+        model = self.settings.openai_model_planner
+        bodies = {}
+        cache_keys = {}
+        for i, question in enumerate(questions):
+            messages = self._build_plan_messages(question)
+            key = _cache_key(model, messages, ToolPlan)
+            # キャッシュ済みの質問はバッチに含めない
+            if self._get_cached_response(key) is not None:
+                continue
+            custom_id = f"{i}_plan"
+            bodies[custom_id] = {
+                "model": model,
+                "messages": messages,
+                "response_format": _response_format_param(ToolPlan),  # Structured Outputsの形式
+                "temperature": 0,
+                "seed": 0,
+            }
+            cache_keys[custom_id] = key
+
+        if not bodies:
+            return
+
+        completions = await self._run_batch(bodies)
+        for custom_id, completion in completions.items():
+            # create_planと同じ形（message.parsedにToolPlanが入った状態）にしてキャッシュに格納
+            # ToolPlanの形式になっていない応答はキャッシュに入れず、create_planで通常どおりAPIを呼び出す
+            message = completion.choices[0].message
+            try:
+                message.parsed = ToolPlan.model_validate_json(message.content or "")
+            except ValidationError as e:
+                logger.warning(f"バッチ内のリクエスト {custom_id} の応答がToolPlanの形式ではありません: {e}")
+                continue
+            self._store_response(cache_keys[custom_id], completion)
+
+    async def arun_agent(self, question: str) -> AgentResult:
+        """
+        エージェントを非同期に実行する（エントリーポイント）
         
         ユーザーからの質問を受け取り、エージェントの全処理を実行して回答を返す。
+        Jupyterなど既にイベントループが動いている環境では、
+        run_agentではなくこちらを `await agent.arun_agent(question)` の形で呼び出す。
         
         実行フロー：
         1. メイングラフを作成
@@ -836,6 +1719,10 @@ class HelpDeskAgent:
            - サブタスク実行（並列）
            - 最終回答作成
         4. 結果をAgentResultオブジェクトにまとめて返す
+
+        各ノードの実行結果はチェックポインターに保存される。
+        同じ質問で再実行すると、前回途中で失敗した場合は完了済みのノードの続きから再開する。
+        前回が最後まで完了している場合は、新しいスレッドで最初から実行する。
         
         例：
         question = "ERR-404エラーの対処法は？"
@@ -853,22 +1740,147 @@ class HelpDeskAgent:
             AgentResult: エージェントの実行結果（計画、サブタスク結果、最終回答を含む）
         """
 
-        # メイングラフ（全体のワークフロー）を作成
-        app = self.create_graph()
-        
-        # グラフを実行
-        # 初期状態として質問とcurrent_stepを設定
-        result = app.invoke(
-            {
-                "question": question,  # ユーザーの質問
-                "current_step": 0,  # 初期ステップは0
-            }
-        )
-        
+        # 同じ質問の実行は1つずつ順番に行い、前回失敗した実行の途中経過を引き継ぐ
+        question_hash = hashlib.blake2b(question.encode()).hexdigest()
+        lock = self._thread_locks.get(question_hash)
+        if lock is None:
+            lock = self._thread_locks[question_hash] = asyncio.Lock()
+
+        # ノードごとの実行時間とトークン数の記録先を、この実行専用に用意する
+        trace: list[NodeTrace] = []
+        trace_token = _run_trace.set(trace)
+        try:
+            async with lock, self._open_checkpointer() as checkpointer:
+                # メイングラフ（全体のワークフロー）を作成
+                # チェックポインターを渡し、各ノードの実行結果を保存しながら進める
+                app = self.create_graph(checkpointer=checkpointer)
+                config, resume = await self._find_thread(app, question_hash)
+
+                if resume:
+                    # 前回の実行が途中で失敗している場合：完了済みのノード（サブタスク）は飛ばして続きから再開
+                    logger.info("前回の実行の途中経過から再開します...")
+                    result = await app.ainvoke(None, config)
+                else:
+                    # グラフを非同期に実行
+                    # 初期状態として質問とcurrent_stepを設定
+                    # 各サブタスクのサブグラフはOpenAIの応答待ちの間に並行して進む
+                    result = await app.ainvoke(
+                        {
+                            "question": question,  # ユーザーの質問
+                            "current_step": 0,  # 初期ステップは0
+                        },
+                        config,
+                    )
+        finally:
+            _run_trace.reset(trace_token)
+
         # 実行結果をAgentResultオブジェクトにまとめて返す
         return AgentResult(
             question=question,  # 元の質問
-            plan=Plan(subtasks=result["plan"]),  # 生成された計画
+            plan=Plan(subtasks=result["plan"]),  # 生成された計画（サブタスクの名前のリスト）
+            subtask_plans=result["subtask_plans"],  # サブタスクごとに最初に実行するツールと引数
             subtasks=result["subtask_results"],  # 各サブタスクの実行結果
             answer=result["last_answer"],  # 最終回答
+            trace=trace,  # ノードごとの実行時間とトークン数
         )
+
+    async def run_agent_stream(self, question: str) -> AsyncIterator[str]:
+        """
+        エージェントを実行し、最終回答をトークン単位で順次返す
+
+        計画作成・サブタスク実行はrun_agentと同じように行い、最終回答の生成だけをストリーミングにする。
+        最終回答の全文が生成されるのを待たずに、最初のトークンが届いた時点から表示を始められる。
+
+        例：
+        async for token in agent.run_agent_stream(question):
+            print(token, end="", flush=True)
+
+        Args:
+            question (str): ユーザーからの質問
+
+        Yields:
+            str: 最終回答のトークン（文字列の断片）
+        """
+        # トークンを受け取るキューを実行時の設定で渡すため、チェックポインターは使わない
+        app = self.create_graph()
+
+        # create_answerから届くトークンを受け取るキュー（Noneはグラフの実行終了を表す）
+        token_queue: asyncio.Queue[str | None] = asyncio.Queue()
+
+        async def run_graph() -> None:
+            try:
+                await app.ainvoke(
+                    {
+                        "question": question,  # ユーザーの質問
+                        "current_step": 0,  # 初期ステップは0
+                    },
+                    config={"configurable": {"token_queue": token_queue}},
+                )
+            finally:
+                await token_queue.put(None)
+
+        # グラフはバックグラウンドで実行し、届いたトークンから順に返す
+        task = asyncio.create_task(run_graph())
+        try:
+            while (token := await token_queue.get()) is not None:
+                yield token
+            # グラフの実行中に発生した例外があればここで送出する
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def run_agent(self, question: str) -> AgentResult:
+        """
+        エージェントを実行する（同期版のエントリーポイント）
+        
+        arun_agentをイベントループ上で実行し、結果を返す。
+        スクリプトなどイベントループが動いていない環境から呼び出すことを想定している。
+        
+        共有しているHTTPクライアントの接続は作成時のイベントループに紐づくため、
+        呼び出しのたびにasyncio.runで新しいループを作るのではなく、同じループを使い回す。
+
+        Args:
+            question (str): ユーザーからの質問
+
+        Returns:
+            AgentResult: エージェントの実行結果（計画、サブタスク結果、最終回答を含む）
+        """
+        if self._runner is None:
+            self._runner = asyncio.Runner()
+        return self._runner.run(self.arun_agent(question))
+
+    async def arun_agent_many(self, questions: list[str]) -> list[AgentResult]:
+        """
+        複数の質問に対してエージェントを非同期に実行する
+
+        各質問のグラフを並行して実行する。settings.use_batch_apiがTrueの場合は、
+        先に全ての質問の計画をBatch APIでまとめて作成してから実行する
+        （評価用のオフライン実行など、応答速度よりもコストを優先する場合を想定）。
+        ツール選択・実行と内省のループは前のステップの結果に依存するため、リアルタイムのAPIで実行する。
+
+        Args:
+            questions (list[str]): ユーザーからの質問のリスト
+
+        Returns:
+            list[AgentResult]: 質問と同じ順番に並んだエージェントの実行結果
+        """
+        if self.settings.use_batch_api:
+            logger.info("🚀 Batch APIで計画をまとめて作成します...")
+            await self._prefetch_plans_with_batch(questions)
+
+        return list(await asyncio.gather(*[self.arun_agent(question) for question in questions]))
+
+    def run_agent_many(self, questions: list[str]) -> list[AgentResult]:
+        """
+        複数の質問に対してエージェントを実行する（同期版）
+
+        Args:
+            questions (list[str]): ユーザーからの質問のリスト
+
+        Returns:
+            list[AgentResult]: 質問と同じ順番に並んだエージェントの実行結果
+        """
+        if self._runner is None:
+            self._runner = asyncio.Runner()
+        return self._runner.run(self.arun_agent_many(questions))
@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
@@ -7,6 +10,38 @@ class Settings(BaseSettings):
     openai_api_key: Optional[str] = None
     openai_api_base: Optional[str] = None
     openai_model: str = "gpt-4o-2024-08-06"
+    # ノードごとのモデル（未設定の場合はopenai_modelを使用）
+    # 例: OPENAI_MODEL_REFLECTION=gpt-4o-mini のように、軽い処理だけ安価なモデルに切り替えられる
+    openai_model_planner: Optional[str] = None
+    openai_model_tool_selection: Optional[str] = None
+    openai_model_subtask_answer: Optional[str] = None
+    openai_model_reflection: Optional[str] = None
+    # 一時的なエラー（429/5xx/タイムアウト）時にOpenAI SDKが自動で再試行する回数
+    openai_max_retries: int = 5
+
+    # 対話履歴の圧縮（要約）用の設定
+    # サブタスクの対話履歴がmax_history_tokensを超えたら、直近history_keep_last_messages件以外を要約する
+    max_history_tokens: int = 4000
+    history_keep_last_messages: int = 6
+    summary_model: str = "gpt-4o-mini"
+
+    # サブタスクごとにツール選択で提示するツールの最大数
+    # 計画作成時に選ばれたツール（allowed_tools）のうち先頭tools_per_subtask個だけを送信する
+    tools_per_subtask: int = 3
+
+    # メッセージ履歴に載せる検索結果の量
+    # 1回のツール実行につき先頭tool_result_max_hits件、1件あたりtool_result_char_limit文字まで
+    tool_result_max_hits: int = 5
+    tool_result_char_limit: int = 800
+
+    # Batch API用の設定
+    # Trueの場合、run_agent_manyで複数の質問の計画をBatch APIでまとめて作成する
+    use_batch_api: bool = False
+    batch_poll_interval_seconds: float = 30.0
+
+    # チェックポイント（グラフの途中経過）を保存するSQLiteファイルのパス
+    # 未設定の場合はメモリ上に保存する（プロセス内での再実行のみ途中から再開できる）
+    checkpoint_db: Optional[str] = None
     
     # Azure OpenAI用の設定
     azure_openai_api_key: Optional[str] = None
@@ -16,3 +51,18 @@ class Settings(BaseSettings):
     azure_openai_api_version: str = "2024-12-01-preview"
 
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    @model_validator(mode="after")
+    def _fill_node_models(self) -> "Settings":
+        # ノードごとのモデルが未設定の場合はopenai_modelを使用する
+        self.openai_model_planner = self.openai_model_planner or self.openai_model
+        self.openai_model_tool_selection = self.openai_model_tool_selection or self.openai_model
+        self.openai_model_subtask_answer = self.openai_model_subtask_answer or self.openai_model
+        self.openai_model_reflection = self.openai_model_reflection or self.openai_model
+        return self
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    # .envの読み込みは初回の呼び出し時だけ行い、以降は同じ設定を返す
+    return Settings()
@@ -0,0 +1,167 @@
+import array
+import asyncio
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+
+from openai import AsyncOpenAI, OpenAI
+from openai.types import CreateEmbeddingResponse
+
+# キャッシュを保存するSQLiteファイルのパス（環境変数EMBEDDING_CACHE_PATHで変更可能）
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", ".embedding_cache.sqlite")
+
+# 1回のEmbedding APIリクエストにまとめるテキストの最大数（APIの上限）
+MAX_EMBEDDING_INPUTS = 2048
+
+
+def _cache_key(text: str, model: str) -> str:
+    """
+    テキストとモデル名からキャッシュのキーを作成する
+
+    同じテキストでもモデルが違えばベクトルも異なるため、モデル名もキーに含める。
+
+    Args:
+        text (str): Embeddingを作成するテキスト
+        model (str): Embeddingモデルの名前
+
+    Returns:
+        str: キャッシュキー（16バイトのハッシュ値の16進数表現）
+    """
+    return hashlib.blake2b(f"{model}\0{text}".encode(), digest_size=16).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    """
+    キャッシュのSQLiteファイルに接続する（テーブルがなければ作成する）
+
+    Returns:
+        sqlite3.Connection: キャッシュのデータベースへの接続
+    """
+    # 複数のスレッドから同時に書き込まれても待ち合わせられるよう、タイムアウトを長めにしておく
+    conn = sqlite3.connect(EMBEDDING_CACHE_PATH, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)")
+    return conn
+
+
+def _lookup(keys: list[str]) -> dict[str, list[float]]:
+    """
+    キャッシュ済みのベクトルを取得する
+
+    Args:
+        keys (list[str]): キャッシュキーのリスト
+
+    Returns:
+        dict[str, list[float]]: キャッシュにあったキーとベクトルの辞書
+    """
+    cached: dict[str, list[float]] = {}
+    unique_keys = list(dict.fromkeys(keys))
+    with closing(_connect()) as conn:
+        # SQLiteのプレースホルダー数の上限を超えないよう、分割して問い合わせる
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start : start + 500]
+            rows = conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, vec in rows:
+                cached[key] = array.array("d", vec).tolist()
+    return cached
+
+
+def _store(vectors: dict[str, list[float]]) -> None:
+    """
+    作成したベクトルをキャッシュに保存する
+
+    Args:
+        vectors (dict[str, list[float]]): キャッシュキーとベクトルの辞書
+    """
+    with closing(_connect()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+            [(key, array.array("d", vec).tobytes()) for key, vec in vectors.items()],
+        )
+
+
+def _miss_batches(keys: list[str], texts: list[str], cached: dict[str, list[float]]) -> list[dict[str, str]]:
+    """
+    キャッシュにないテキストを、1回のAPIリクエストで送れる数ずつに分ける（同じテキストは1回だけ）
+
+    Args:
+        keys (list[str]): キャッシュキーのリスト
+        texts (list[str]): keysに対応するテキストのリスト
+        cached (dict[str, list[float]]): キャッシュにあったキーとベクトルの辞書
+
+    Returns:
+        list[dict[str, str]]: キャッシュキーとテキストの辞書のリスト（1要素が1リクエスト分）
+    """
+    misses = {key: text for key, text in zip(keys, texts, strict=True) if key not in cached}
+    miss_keys = list(misses)
+    return [
+        {key: misses[key] for key in miss_keys[start : start + MAX_EMBEDDING_INPUTS]}
+        for start in range(0, len(miss_keys), MAX_EMBEDDING_INPUTS)
+    ]
+
+
+def _to_vectors(batch: dict[str, str], response: CreateEmbeddingResponse) -> dict[str, list[float]]:
+    # 入力と同じ順番で返ってくるが、念のためindexで並べ替える
+    # ベクトルの数が入力と合わない場合は、ベクトルのないテキストを残さないようエラーとする
+    return {
+        key: data.embedding
+        for key, data in zip(batch, sorted(response.data, key=lambda d: d.index), strict=True)
+    }
+
+
+def get_or_embed(texts: list[str], client: OpenAI, model: str) -> list[list[float]]:
+    """
+    テキストのEmbeddingをキャッシュから取得し、キャッシュにないものだけOpenAI APIで作成する
+
+    キャッシュはテキストの内容のハッシュ値をキーにしてSQLiteファイルに保存するため、
+    同じ文書を再インデックスする場合や同じクエリで検索する場合にAPIの呼び出しと料金を省略できる。
+
+    Args:
+        texts (list[str]): Embeddingを作成するテキストのリスト
+        client (OpenAI): Embeddingの作成に使用するOpenAI APIクライアント
+        model (str): Embeddingモデルの名前
+
+    Returns:
+        list[list[float]]: textsと同じ順番に並んだEmbeddingのリスト
+    """
+    keys = [_cache_key(text, model) for text in texts]
+    cached = _lookup(keys)
+
+    # キャッシュにないテキストだけをまとめてAPIでベクトル化し、キャッシュに保存する
+    for batch in _miss_batches(keys, texts, cached):
+        response = client.embeddings.create(model=model, input=list(batch.values()))
+        vectors = _to_vectors(batch, response)
+        _store(vectors)
+        cached.update(vectors)
+
+    return [cached[key] for key in keys]
+
+
+async def aget_or_embed(texts: list[str], client: AsyncOpenAI, model: str) -> list[list[float]]:
+    """
+    get_or_embedの非同期版（AsyncOpenAIクライアントでEmbeddingを作成する）
+
+    APIのレスポンスを待つ間はSQLiteの接続を保持しないため、複数のバッチを並行して処理できる。
+    SQLiteの読み書きはブロックする処理のため、別スレッドで実行してイベントループを止めないようにする。
+
+    Args:
+        texts (list[str]): Embeddingを作成するテキストのリスト
+        client (AsyncOpenAI): Embeddingの作成に使用するOpenAI APIクライアント
+        model (str): Embeddingモデルの名前
+
+    Returns:
+        list[list[float]]: textsと同じ順番に並んだEmbeddingのリスト
+    """
+    keys = [_cache_key(text, model) for text in texts]
+    cached = await asyncio.to_thread(_lookup, keys)
+
+    for batch in _miss_batches(keys, texts, cached):
+        response = await client.embeddings.create(model=model, input=list(batch.values()))
+        vectors = _to_vectors(batch, response)
+        await asyncio.to_thread(_store, vectors)
+        cached.update(vectors)
+
+    return [cached[key] for key in keys]
@@ -46,10 +46,21 @@ class SearchOutput(BaseModel):
         )
 
 
+class SubtaskPlan(BaseModel):
+    name: str = Field(..., description="サブタスクの内容")
+    tool_name: str = Field(..., description="サブタスクで最初に実行するツールの名前")
+    tool_args: str = Field(..., description="ツールに渡す引数（JSON形式の文字列）")
+    allowed_tools: list[str] = Field(..., description="サブタスクで使う可能性のあるツールの名前のリスト")
+
+
 class Plan(BaseModel):
     subtasks: list[str] = Field(..., description="問題を解決するためのサブタスクリスト")
 
 
+class ToolPlan(BaseModel):
+    subtasks: list[SubtaskPlan] = Field(..., description="問題を解決するためのサブタスクリスト")
+
+
 class ToolResult(BaseModel):
     tool_name: str = Field(..., description="ツールの名前")
     args: str = Field(..., description="ツールの引数")
@@ -80,8 +91,19 @@ class Subtask(BaseModel):
     challenge_count: int = Field(..., description="サブタスクの挑戦回数")
 
 
+class NodeTrace(BaseModel):
+    node: str = Field(..., description="ノードの名前")
+    elapsed_ns: int = Field(..., description="ノードの実行時間（ナノ秒）")
+    prompt_tokens: int = Field(0, description="ノード内のOpenAI API呼び出しの入力トークン数の合計")
+    completion_tokens: int = Field(0, description="ノード内のOpenAI API呼び出しの出力トークン数の合計")
+
+
 class AgentResult(BaseModel):
     question: str = Field(..., description="ユーザーの元の質問")
     plan: Plan = Field(..., description="エージェントの計画")
+    subtask_plans: list[SubtaskPlan] = Field(
+        default_factory=list, description="サブタスクごとに最初に実行するツールと引数の計画"
+    )
     subtasks: list[Subtask] = Field(..., description="サブタスクのリスト")
     answer: str = Field(..., description="最終的な回答")
+    trace: list[NodeTrace] = Field(default_factory=list, description="ノードごとの実行時間とトークン数")
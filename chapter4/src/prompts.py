@@ -7,12 +7,15 @@ PLANNER_SYSTEM_PROMPT = """
 - サブタスクはどんな内容について知りたいのかを具体的かつ詳細に記述すること
 - サブタスクは同じ内容を調査しないように重複なく構成すること
 - 必要最小限のサブタスクを作成すること
+- サブタスクごとに、最初に実行するツールの名前（tool_name）と引数（tool_args）を利用可能なツールの中から選ぶこと
+- tool_argsはツールの引数をJSON形式の文字列で記述すること
+- サブタスクの調査に使う可能性のあるツールの名前をallowed_toolsに列挙すること（tool_nameも含め、必要なものだけ）
 
 # 例
 質問: AとBの違いについて教えて
 計画:
-- Aとは何かについて調べる
-- Bとは何かについて調べる
+- Aとは何かについて調べる（tool_name: search_xyz_manual, tool_args: {"keywords": "A"}）
+- Bとは何かについて調べる（tool_name: search_xyz_manual, tool_args: {"keywords": "B"}）
 
 """
 
@@ -67,6 +70,17 @@ SUBTASK_RETRY_ANSWER_USER_PROMPT = """
 1.ツール選択・実行をリフレクションの結果に従ってやり直してください
 """
 
+HISTORY_SUMMARY_SYSTEM_PROMPT = """
+あなたはXYZというシステムの質問応答のためにサブタスク実行を担当するエージェントの補佐役です。
+これから渡すのは、サブタスク実行中のツール選択・ツール実行結果・サブタスク回答・リフレクションの対話履歴です。
+以降のツール選択・実行のやり直しに必要な情報が失われないように、以下の指示に従って簡潔に要約してください。
+
+- 使用したツール名と検索キーワード（引数）を全て残すこと
+- ツールの実行結果から分かった事実を残すこと
+- リフレクションの評価とアドバイスの内容を残すこと
+- 対話履歴に含まれない情報を追加しないこと
+"""
+
 CREATE_LAST_ANSWER_SYSTEM_PROMPT = """
 あなたはXYZというシステムのヘルプデスク回答作成担当です。
 回答までの全体の流れは計画立案 → サブタスク実行 [ツール実行 → サブタスク回答 → リフレクション] → 最終回答となります。
@@ -77,13 +91,14 @@ CREATE_LAST_ANSWER_SYSTEM_PROMPT = """
 - 回答は聞かれたことに対して簡潔で明確にすることを心がけてください
 - あなたが知り得た情報から回答し、不確定な情報や推測を含めないでください
 - 調べた結果から回答がわからなかった場合は、その旨を素直に回答に含めた上で引き続き調査することを伝えてください
+- 「【未検証】」で始まるサブタスクの回答は内容を確認できていないため、不確かな情報として扱ってください
 - 回答の中で質問者に対して別のチームに問い合わせるように促すことは避けてください
 """
 
 CREATE_LAST_ANSWER_USER_PROMPT = """
 ユーザーの質問: {question}
 
-回答のための計画と実行結果: {subtask_results}
+回答のための計画と実行結果（JSON形式。t: サブタスク, a: サブタスクの回答）: {subtask_results}
 
 回答を作成してください
 """
@@ -98,6 +113,7 @@ class HelpDeskAgentPrompts:
         subtask_tool_selection_user_prompt: str = SUBTASK_TOOL_EXECUTION_USER_PROMPT,
         subtask_reflection_user_prompt: str = SUBTASK_REFLECTION_USER_PROMPT,
         subtask_retry_answer_user_prompt: str = SUBTASK_RETRY_ANSWER_USER_PROMPT,
+        history_summary_system_prompt: str = HISTORY_SUMMARY_SYSTEM_PROMPT,
         create_last_answer_system_prompt: str = CREATE_LAST_ANSWER_SYSTEM_PROMPT,
         create_last_answer_user_prompt: str = CREATE_LAST_ANSWER_USER_PROMPT,
     ) -> None:
@@ -107,5 +123,6 @@ class HelpDeskAgentPrompts:
         self.subtask_tool_selection_user_prompt = subtask_tool_selection_user_prompt
         self.subtask_reflection_user_prompt = subtask_reflection_user_prompt
         self.subtask_retry_answer_user_prompt = subtask_retry_answer_user_prompt
+        self.history_summary_system_prompt = history_summary_system_prompt
         self.create_last_answer_system_prompt = create_last_answer_system_prompt
         self.create_last_answer_user_prompt = create_last_answer_user_prompt
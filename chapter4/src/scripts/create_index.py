@@ -1,39 +1,85 @@
+import asyncio
 import os
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from glob import glob
 
+import httpx
 from elasticsearch import Elasticsearch, helpers
-from langchain_community.document_loaders import PyPDFLoader
+from elasticsearch.serializer import OrjsonSerializer
 from langchain_community.document_loaders.csv_loader import CSVLoader
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from openai import OpenAI
-from pydantic_settings import BaseSettings, SettingsConfigDict
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, PointStruct, VectorParams
+from openai import AsyncOpenAI
+from pypdf import PdfReader
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (
+    Distance,
+    PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    VectorParams,
+)
+
+from src.configs import Settings, get_settings
+from src.embedding_cache import aget_or_embed
+
+# 1回のEmbedding APIリクエストにまとめるテキストの数（APIの上限は2048件）
+BATCH_SIZE = 256
+# 同時に送信するEmbedding APIリクエストの数（環境変数EMBEDDING_CONCURRENCYで変更可能）
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "5"))
+# Qdrantに登録する前にテキストから取り除く文字（半角スペース）の変換テーブル
+_WS_TABLE = str.maketrans("", "", " ")
+
+
+def create_openai_client(settings: Settings) -> AsyncOpenAI:
+    # 全てのEmbeddingリクエストで同じ接続を使い回せるよう、キープアライブする接続数を多めに確保する
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+    )
+    # Azure OpenAIの設定がある場合はAzure OpenAIを使用、なければ通常のOpenAIを使用
+    if settings.azure_openai_api_key:
+        # Azure OpenAI用の初期化（Embedding用デプロイメントを使用）
+        return AsyncOpenAI(
+            api_key=settings.azure_openai_api_key,
+            base_url=f"{settings.azure_openai_endpoint}/openai/deployments/{settings.azure_openai_embedding_deployment_name}",
+            default_query={"api-version": settings.azure_openai_api_version},
+            http_client=http_client,
+        )
+    # 通常のOpenAI用の初期化
+    return AsyncOpenAI(api_key=settings.openai_api_key, http_client=http_client)
+
 
+def _load_and_split_pdf(path: str) -> list[Document]:
+    # チャンクの長さは文字数ではなく、Embeddingモデルと同じcl100k_baseのトークン数で測る
+    # （tiktokenはRust実装のため、分割中に何度も長さを測っても速い）
+    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base",
+        # チャンクサイズを小さく設定（デモ用）
+        chunk_size=300,
+        chunk_overlap=20,
+        is_separator_regex=False,
+    )
+    # ページごとにDocumentを作ってから分割するのではなく、全ページのテキストをまとめて1回で分割する
+    reader = PdfReader(path)
+    full_text = "\n".join(page.extract_text() for page in reader.pages)
+    return text_splitter.create_documents([full_text], metadatas=[{"source": path}])
 
-class Settings(BaseSettings):
-    openai_api_key: str
-    openai_api_base: str
-    openai_model: str
 
-    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+def _load_csv(path: str) -> list[Document]:
+    loader = CSVLoader(file_path=path)
+    return loader.load()
 
 
 def load_pdf_docs(data_dir_path: str) -> list[Document]:
     pdf_path = glob(os.path.join(data_dir_path, "**", "*.pdf"), recursive=True)
     docs = []
-    text_splitter = RecursiveCharacterTextSplitter(
-        # チャンクサイズを小さく設定（デモ用）
-        chunk_size=300,
-        chunk_overlap=20,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    for path in pdf_path:
-        loader = PyPDFLoader(path)
-        pages = loader.load_and_split(text_splitter)
-        docs.extend(pages)
+    # PDFの解析と分割はCPU負荷が高いため、ファイルごとに別プロセスで並列に処理する
+    # mapは入力と同じ順番で結果を返すため、ドキュメントの順番は逐次処理の場合と変わらない
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for pages in executor.map(_load_and_split_pdf, pdf_path):
+            docs.extend(pages)
 
     return docs
 
@@ -42,9 +88,10 @@ def load_csv_docs(data_dir_path: str) -> list[Document]:
     csv_path = glob(os.path.join(data_dir_path, "**", "*.csv"), recursive=True)
     docs = []
 
-    for path in csv_path:
-        loader = CSVLoader(file_path=path)
-        docs.extend(loader.load())
+    # CSVの読み込みはI/Oが中心のため、スレッドで並列に処理する
+    with ThreadPoolExecutor() as executor:
+        for rows in executor.map(_load_csv, csv_path):
+            docs.extend(rows)
 
     return docs
 
@@ -100,18 +147,25 @@ def create_keyword_search_index(es: Elasticsearch, index_name: str) -> None:
     }
 
     # インデックスの作成
-    if not es.indices.exists(index=index_name):
-        result = es.indices.create(index=index_name, body=mapping)
-        if result:
-            print(f"インデックス {index_name} を正常に作成しました")
-        else:
-            print(f"インデックス {index_name} の作成に失敗しました")
+    # 事前に存在確認のリクエストを送らず、作成を試みて「既に存在する」エラー（400）を無視する
+    result = es.options(ignore_status=400).indices.create(index=index_name, body=mapping)
+    if result.get("acknowledged"):
+        print(f"インデックス {index_name} を正常に作成しました")
+    elif result.get("error", {}).get("type") == "resource_already_exists_exception":
+        print(f"インデックス {index_name} は既に存在します")
+    else:
+        print(f"インデックス {index_name} の作成に失敗しました: {result}")
 
 
 def create_vector_search_index(qdrant_client: QdrantClient, index_name: str) -> None:
     result = qdrant_client.create_collection(
         collection_name=index_name,
-        vectors_config=VectorParams(size=1536, distance=Distance.COSINE),
+        # 元のfloat32のベクトルはディスクに置き、検索にはメモリ上のint8に量子化したベクトルを使う
+        # （1件あたりのメモリ使用量が約6KBから約1.5KBになる）
+        vectors_config=VectorParams(size=1536, distance=Distance.COSINE, on_disk=True),
+        quantization_config=ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True),
+        ),
     )
     if result:
         print(f"コレクション {index_name} を正常に作成しました")
@@ -122,76 +176,90 @@ def create_vector_search_index(qdrant_client: QdrantClient, index_name: str) ->
 def add_documents_to_es(
     es: Elasticsearch, index_name: str, docs: list[Document]
 ) -> None:
-    insert_docs = []
-
-    for doc in docs:
-        content = doc.page_content
-
-        # ドキュメントの作成
-        insert_doc = {
-            "_index": index_name,
-            "_source": {
-                "file_name": os.path.basename(doc.metadata["source"]),
-                "content": content,
-            },
-        }
-        insert_docs.append(insert_doc)
+    def generate_docs():
+        # ドキュメントを1件ずつ生成し、全件のリストをメモリ上に作らないようにする
+        for doc in docs:
+            yield {
+                "_index": index_name,
+                "_source": {
+                    "file_name": os.path.basename(doc.metadata["source"]),
+                    "content": doc.page_content,
+                },
+            }
 
     # Elasticsearchにドキュメントを追加
-    helpers.bulk(es, insert_docs)
-
-
-def add_documents_to_qdrant(
-    qdrant_client: QdrantClient,
+    # 1回のリクエストで最大5000件（10MB）ずつまとめて送信する
+    for ok, info in helpers.streaming_bulk(
+        es,
+        generate_docs(),
+        chunk_size=5000,
+        max_chunk_bytes=10 * 1024 * 1024,
+        raise_on_error=False,
+    ):
+        if not ok:
+            print(f"ドキュメントの追加に失敗しました: {info}")
+
+
+async def add_documents_to_qdrant_async(
+    client: AsyncOpenAI,
+    qdrant_client: AsyncQdrantClient,
     index_name: str,
     docs: list[Document],
-    settings: Settings,
 ) -> None:
-    points = []
-    
-    # OpenAI APIクライアントを初期化（Embedding生成に使用）
-    # Azure OpenAIの設定がある場合はAzure OpenAIを使用、なければ通常のOpenAIを使用
-    if settings.azure_openai_api_key:
-        # Azure OpenAI用の初期化（Embedding用デプロイメントを使用）
-        client = OpenAI(
-            api_key=settings.azure_openai_api_key,
-            base_url=f"{settings.azure_openai_endpoint}/openai/deployments/{settings.azure_openai_embedding_deployment_name}",
-            default_query={"api-version": settings.azure_openai_api_version},
-        )
-    else:
-        # 通常のOpenAI用の初期化
-        client = OpenAI(api_key=settings.openai_api_key)
-
-    for i, doc in enumerate(docs):
-        content = doc.page_content
-        content = content.replace(" ", "")
-        embedding = client.embeddings.create(
-            model="text-embedding-3-small", input=content
-        )
-        points.append(
+    # 同時に送信するEmbedding APIリクエストの数を制限する
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    # 半角スペースの除去は最初に全件まとめて1回だけ行い、Embeddingの入力とpayloadの両方で使う
+    normalized = [doc.page_content.translate(_WS_TABLE) for doc in docs]
+
+    async def embed_and_upsert(start: int) -> object:
+        doc_batch = docs[start : start + BATCH_SIZE]
+        content_batch = normalized[start : start + BATCH_SIZE]
+        async with semaphore:
+            # 同時に送信したリクエストが一斉にレート制限に当たらないよう、送信タイミングを少しずらす
+            await asyncio.sleep(random.uniform(0, 0.05))
+            # 以前にベクトル化したことのあるテキストはキャッシュから取得し、APIを呼ばない
+            vectors = await aget_or_embed(content_batch, client, "text-embedding-3-small")
+
+        # 登録はセマフォの外で行い、その間に次のバッチのEmbedding作成を進める
+        points = [
             PointStruct(
-                id=i,
-                vector=embedding.data[0].embedding,
+                id=start + offset,
+                vector=vector,
                 payload={
                     "file_name": os.path.basename(doc.metadata["source"]),
                     "content": content,
                 },
             )
-        )
-
-    operation_info = qdrant_client.upsert(
-        collection_name=index_name,
-        points=points,
-        wait=True,
+            for offset, (doc, content, vector) in enumerate(zip(doc_batch, content_batch, vectors, strict=True))
+        ]
+        # 並行して登録するため、各バッチの登録が反映されるまで待ってから完了とする
+        return await qdrant_client.upsert(collection_name=index_name, points=points, wait=True)
+
+    # BATCH_SIZE件ずつまとめてEmbeddingを作成し、ベクトル化できたバッチから順に登録する
+    # Embedding作成のレスポンス待ちと登録のレスポンス待ちを重ねて、全体の待ち時間を短くする
+    operation_infos = await asyncio.gather(
+        *(embed_and_upsert(start) for start in range(0, len(docs), BATCH_SIZE))
     )
-    print(operation_info)
+    print(operation_infos[-1] if operation_infos else None)
+
+
+def add_documents_to_qdrant(
+    qdrant_client: AsyncQdrantClient,
+    index_name: str,
+    docs: list[Document],
+    client: AsyncOpenAI,
+) -> None:
+    # 同期コードからも従来どおり呼び出せるよう、非同期版をイベントループ上で実行する
+    asyncio.run(add_documents_to_qdrant_async(client, qdrant_client, index_name, docs))
 
 
 if __name__ == "__main__":
-    es = Elasticsearch("http://localhost:9200")
-    qdrant_client = QdrantClient("http://localhost:6333")
+    # バルク登録では大量の小さなJSONを作るため、標準のjsonモジュールより高速なorjsonでシリアライズする
+    es = Elasticsearch("http://localhost:9200", serializer=OrjsonSerializer())
+    # ベクトルはJSONの数値の配列ではなくprotobufのバイナリで送る方が小さいため、gRPC（6334番ポート）で接続する
+    qdrant_client = QdrantClient("http://localhost:6333", prefer_grpc=True)
 
-    settings = Settings()
+    settings = get_settings()
 
     index_name = "documents"
     print(f"キーワード検索用のインデックス {index_name} を作成中")
@@ -215,6 +283,9 @@ if __name__ == "__main__":
     print("--------------------------------")
 
     print("ベクトル検索インデックスにドキュメントを追加中")
-    add_documents_to_qdrant(qdrant_client, index_name, qa_docs, settings)
+    # Embedding生成用のOpenAI APIクライアントは1つだけ作成して使い回す
+    openai_client = create_openai_client(settings)
+    async_qdrant_client = AsyncQdrantClient("http://localhost:6333", prefer_grpc=True)
+    add_documents_to_qdrant(async_qdrant_client, index_name, qa_docs, openai_client)
     print("--------------------------------")
     print("完了")
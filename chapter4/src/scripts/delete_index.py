@@ -4,11 +4,12 @@ from qdrant_client import QdrantClient
 
 def delete_es_index(es: Elasticsearch, index_name: str) -> None:
     # インデックスの削除
-    if es.indices.exists(index=index_name):
-        es.indices.delete(index=index_name)
-        print(f"インデックス '{index_name}' を削除しました")
-    else:
+    # 事前に存在確認のリクエストを送らず、削除を試みて「存在しない」エラー（404）を無視する
+    result = es.options(ignore_status=404).indices.delete(index=index_name)
+    if result.meta.status == 404:
         print(f"インデックス '{index_name}' は存在しません")
+    else:
+        print(f"インデックス '{index_name}' を削除しました")
 
 
 def delete_qdrant_index(qdrant_client: QdrantClient, collection_name: str) -> None:
@@ -1,4 +1,7 @@
+from functools import lru_cache
+
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 
@@ -11,6 +14,16 @@ MAX_SEARCH_RESULTS = 3
 logger = setup_logger(__file__)
 
 
+@lru_cache(maxsize=1)
+def _get_es_client() -> Elasticsearch:
+    """
+    Elasticsearchクライアントを取得する（初回呼び出し時に作成し、以降は同じものを返す）
+    """
+    # 検索のたびに接続を確立し直さないよう、ローカルのElasticsearchへの接続を使い回す
+    # リクエストとレスポンスのJSONは、標準のjsonモジュールより高速なorjsonで処理する
+    return Elasticsearch("http://localhost:9200", serializer=OrjsonSerializer())
+
+
 # 入力スキーマを定義するクラス
 class SearchKeywordInput(BaseModel):
     # Field は Pydantic のフィールド定義関数です。モデルのフィールドに追加のメタデータや検証ルールを付与するために使います。
@@ -27,8 +40,8 @@ def search_xyz_manual(keywords: str) -> list[SearchOutput]:
 
     logger.info(f"キーワードでXYZマニュアルを検索中: {keywords}")
 
-    # Elasticsearchのインスタンスを作成して、ローカルのElasticsearchに接続
-    es = Elasticsearch("http://localhost:9200")
+    # ローカルのElasticsearchに接続するクライアントを取得（2回目以降は同じ接続を使い回す）
+    es = _get_es_client()
 
     # 検索対象のインデックスを指定 
     index_name = "documents"
@@ -1,3 +1,8 @@
+# functools: クライアントとクエリのEmbeddingをプロセス内でキャッシュするのに使用
+from functools import lru_cache
+
+# httpx: OpenAIクライアントが内部で使用するHTTPクライアント（接続のキープアライブの設定に使用）
+import httpx
 # LangChainのtoolデコレーターをインポート（ツールとして関数を登録するため）
 from langchain.tools import tool
 # OpenAI APIクライアントをインポート（Embeddingの生成に使用）
@@ -8,9 +13,11 @@ from pydantic import BaseModel, Field
 from qdrant_client import QdrantClient
 
 # アプリケーション設定（API キーなど）を読み込むためのモジュール
-from src.configs import Settings
+from src.configs import get_settings
 # カスタムロガーのセットアップ関数をインポート
 from src.custom_logger import setup_logger
+# Embeddingのキャッシュ（同じクエリのベクトル化でAPIを呼ばないようにする）
+from src.embedding_cache import get_or_embed
 # 検索結果を格納するデータモデルをインポート
 from src.models import SearchOutput
 
@@ -21,6 +28,72 @@ MAX_SEARCH_RESULTS = 3
 logger = setup_logger(__name__)
 
 
+@lru_cache(maxsize=1)
+def _get_qdrant_client() -> QdrantClient:
+    """
+    Qdrantクライアントを取得する（初回呼び出し時に作成し、以降は同じものを返す）
+
+    検索のたびにクライアントを作り直すと、接続の確立からやり直しになるため使い回す。
+
+    Returns:
+        QdrantClient: ローカルのQdrantに接続するクライアント
+    """
+    # Qdrantはベクトル検索に特化したデータベース
+    # クエリのベクトルをprotobufのバイナリで送れるよう、gRPC（6334番ポート）で接続する
+    return QdrantClient("http://localhost:6333", prefer_grpc=True)
+
+
+@lru_cache(maxsize=1)
+def _get_openai_client() -> OpenAI:
+    """
+    Embedding生成用のOpenAI APIクライアントを取得する（初回呼び出し時に作成し、以降は同じものを返す）
+
+    Returns:
+        OpenAI: OpenAI APIクライアント
+    """
+    # 設定ファイルから各種設定値（API キーなど）を読み込む
+    settings = get_settings()
+
+    # 検索のたびに接続を確立し直さないよう、接続をキープアライブして使い回す
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+    )
+
+    # Azure OpenAIの設定がある場合はAzure OpenAIを使用、なければ通常のOpenAIを使用
+    if settings.azure_openai_api_key:
+        # Azure OpenAI用の初期化（Embedding用デプロイメントを使用）
+        return OpenAI(
+            api_key=settings.azure_openai_api_key,
+            base_url=f"{settings.azure_openai_endpoint}/openai/deployments/{settings.azure_openai_embedding_deployment_name}",
+            default_query={"api-version": settings.azure_openai_api_version},
+            http_client=http_client,
+        )
+    # 通常のOpenAI用の初期化
+    return OpenAI(api_key=settings.openai_api_key, http_client=http_client)
+
+
+@lru_cache(maxsize=1024)
+def _embed_query(query: str) -> tuple[float, ...]:
+    """
+    検索クエリをベクトル化する（同じクエリの結果はプロセス内でキャッシュする）
+
+    エージェントのリトライでは同じクエリで繰り返し検索することがあるため、
+    2回目以降はAPIもディスク上のキャッシュも参照せずに結果を返す。
+    キャッシュした値が書き換えられないよう、タプルで返す。
+
+    Args:
+        query (str): 検索クエリ
+
+    Returns:
+        tuple[float, ...]: クエリのベクトル
+    """
+    # OpenAIのEmbedding APIを使って、入力クエリをベクトル（数値の配列）に変換
+    # text-embedding-3-small モデルを使用（高速かつコスト効率が良い）
+    # ベクトル化することで、意味的に類似したテキストを数学的に比較できる
+    # 以前に同じクエリをベクトル化している場合はディスク上のキャッシュから取得する
+    return tuple(get_or_embed([query], _get_openai_client(), "text-embedding-3-small")[0])
+
+
 # 入力スキーマを定義するクラス
 # Pydanticを使って、ツールへの入力パラメータを型安全に定義
 class SearchQueryInput(BaseModel):
@@ -41,36 +114,13 @@ def search_xyz_qa(query: str) -> list[SearchOutput]:
     # 検索処理の開始をログに記録
     logger.info(f"Searching XYZ QA by query: {query}")
 
-    # Qdrantクライアントのインスタンスを作成し、ローカルのQdrantに接続
-    # Qdrantはベクトル検索に特化したデータベース
-    qdrant_client = QdrantClient("http://localhost:6333")
-
-    # 設定ファイルから各種設定値（API キーなど）を読み込む
-    settings = Settings()
-    
-    # OpenAI APIクライアントを初期化（Embedding生成に使用）
-    # Azure OpenAIの設定がある場合はAzure OpenAIを使用、なければ通常のOpenAIを使用
-    if settings.azure_openai_api_key:
-        # Azure OpenAI用の初期化（Embedding用デプロイメントを使用）
-        openai_client = OpenAI(
-            api_key=settings.azure_openai_api_key,
-            base_url=f"{settings.azure_openai_endpoint}/openai/deployments/{settings.azure_openai_embedding_deployment_name}",
-            default_query={"api-version": settings.azure_openai_api_version},
-        )
-    else:
-        # 通常のOpenAI用の初期化
-        openai_client = OpenAI(api_key=settings.openai_api_key)
-
     # クエリテキストをベクトル化する処理の開始をログに記録
     logger.info("Generating embedding vector from input query")
-    # OpenAIのEmbedding APIを使って、入力クエリをベクトル（数値の配列）に変換
-    # text-embedding-3-small モデルを使用（高速かつコスト効率が良い）
-    # ベクトル化することで、意味的に類似したテキストを数学的に比較できる
-    query_vector = (
-        openai_client.embeddings.create(input=query, model="text-embedding-3-small")
-        .data[0]
-        .embedding
-    )
+    # 同じクエリは一度だけベクトル化し、2回目以降はプロセス内のキャッシュから取得する
+    query_vector = list(_embed_query(query))
+
+    # Qdrantクライアント（初回呼び出し時に作成したものを使い回す）
+    qdrant_client = _get_qdrant_client()
 
     # Qdrantでベクトル検索を実行
     # collection_name: 検索対象のコレクション名
@@ -3,7 +3,7 @@
 Azure OpenAI の設定をテストするスクリプト
 """
 from openai import OpenAI
-from src.configs import Settings
+from src.configs import Settings, get_settings
 
 
 def test_settings():
@@ -12,7 +12,7 @@ def test_settings():
     print("1. 設定の読み込みテスト")
     print("=" * 60)
     
-    settings = Settings()
+    settings = get_settings()
     
     # Azure OpenAI の設定確認
     if settings.azure_openai_api_key:
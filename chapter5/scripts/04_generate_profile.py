@@ -46,6 +46,12 @@ PythonのAI・機械学習プログラミングに適した言語でデータマ
 {{ role }}
 </ペルソナ要求>"""
 
+# テンプレートのコンパイルはレンダリングより重いため、モジュールの読み込み時に1度だけ行う
+_PROMPT_TEMPLATE = Template(source=PROMPT)
+
+# 生成されたテキストから除去するタグ（<ペルソナ定義書>など）のパターン
+_TAG_RE = re.compile(r"<.*?>")
+
 
 def generate_profile(
     role: str,
@@ -63,8 +69,7 @@ def generate_profile(
     """
     # Jinja2テンプレートを使用してプロンプトを生成
     # {{ role }}の部分に実際の役割を埋め込む
-    prompt_template = Template(source=PROMPT)
-    message = prompt_template.render(role=role)
+    message = _PROMPT_TEMPLATE.render(role=role)
     
     # LLMを呼び出してペルソナ定義書を生成
     response = openai.generate_response(
@@ -74,7 +79,7 @@ def generate_profile(
     
     # 生成されたテキストからHTMLタグを除去して整形
     # <ペルソナ定義書>などのタグを削除し、純粋なテキストのみを残す
-    response.content = re.sub(r"<.*?>", "", response.content).strip()
+    response.content = _TAG_RE.sub("", response.content).strip()
     return response
 
 
@@ -11,12 +11,10 @@ E2B Sandboxを使用してPythonコードを実行し、
 4. 実行結果をJSON形式で出力
 """
 
-import io
 import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-from e2b_code_interpreter import Sandbox
 
 from rich import print
 
@@ -25,7 +23,7 @@ from rich import print
 root_dir = Path(__file__).resolve().parents[1]
 sys.path.append(str(root_dir))
 
-from src.modules import execute_code, set_dataframe
+from src.modules import close_sandbox, execute_code, get_sandbox, set_dataframe
 
 
 # 環境変数を読み込み（E2B_API_KEYなど）
@@ -39,27 +37,30 @@ def main() -> None:
     E2B Sandboxを使用してデータフレームの操作を実行し、
     その結果をJSON形式で出力します。
     """
-    # E2B Sandboxインスタンスを作成し、コンテキストマネージャーとして使用
-    # with文を使用することで、リソースの適切な管理が保証される
-    with Sandbox() as sandbox:
-        # CSVファイルをデータフレームとしてSandboxに読み込み
-        # set_dataframe関数を使用して、dfという変数名でデータフレームを作成
-        with open("data/sample.csv", "rb") as fi:
-            set_dataframe(sandbox=sandbox, file_object=io.BytesIO(fi.read()))
-        
-        # データフレームの形状（行数・列数）を確認するコードを実行
-        data_thread = execute_code(
-            sandbox=sandbox,  # E2B Sandboxインスタンス
-            process_id="06_execute_code",  # プロセスID（実行識別子）
-            thread_id=0,  # スレッドID（試行回数）
-            code="print(df.shape)",  # 実行するPythonコード
-        )
-        
-        # 実行結果をJSON形式で出力
-        # data_threadには実行結果、標準出力、標準エラーなどが含まれる
-        print(data_thread.model_dump_json(indent=4))
+    # 共有のE2B Sandboxを取得（初回のみ作成される）
+    sandbox = get_sandbox()
+    # CSVファイルをデータフレームとしてSandboxに読み込み
+    # set_dataframe関数を使用して、dfという変数名でデータフレームを作成
+    with open("data/sample.csv", "rb") as fi:
+        set_dataframe(sandbox=sandbox, file_object=fi)
+    
+    # データフレームの形状（行数・列数）を確認するコードを実行
+    data_thread = execute_code(
+        sandbox=sandbox,  # E2B Sandboxインスタンス
+        process_id="06_execute_code",  # プロセスID（実行識別子）
+        thread_id=0,  # スレッドID（試行回数）
+        code="print(df.shape)",  # 実行するPythonコード
+    )
+    
+    # 実行結果をJSON形式で出力
+    # data_threadには実行結果、標準出力、標準エラーなどが含まれる
+    print(data_thread.model_dump_json(indent=4))
 
 
 if __name__ == "__main__":
     # スクリプトが直接実行された場合のみmain関数を呼び出す
-    main()
+    try:
+        main()
+    finally:
+        # 実行が終わったら、プロセスの終了を待たずに共有のSandboxを破棄する
+        close_sandbox()
@@ -16,7 +16,6 @@ import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-from e2b_code_interpreter import Sandbox
 from loguru import logger
 
 
@@ -26,9 +25,11 @@ root_dir = Path(__file__).resolve().parents[1]
 sys.path.append(str(root_dir))
 
 from src.modules import (
+    close_sandbox,
     describe_dataframe,
     execute_code,
     generate_review,
+    get_sandbox,
     set_dataframe,
 )
 
@@ -55,23 +56,23 @@ def main() -> None:
         file_object = io.BytesIO(fi.read())
     data_info = describe_dataframe(file_object=file_object, template_file=template_file)
 
-    # E2B Sandboxを使用してコードを実行
-    with Sandbox() as sandbox:
-        # CSVファイルをデータフレームとしてSandboxに読み込み
-        with open(data_path, "rb") as fi:
-            set_dataframe(sandbox=sandbox, file_object=io.BytesIO(fi.read()))
-        
-        # データフレームの形状を確認するコードを実行
-        data_thread = execute_code(
-            process_id=process_id,
-            thread_id=0,
-            sandbox=sandbox,
-            user_request=user_request,
-            code="print(df.shape)",  # 実行するPythonコード
-        )
-        
-        # 実行結果をログに出力
-        logger.info(data_thread.model_dump())
+    # 共有のE2B Sandboxを使用してコードを実行（初回のみ作成される）
+    sandbox = get_sandbox()
+    # CSVファイルをデータフレームとしてSandboxに読み込み
+    with open(data_path, "rb") as fi:
+        set_dataframe(sandbox=sandbox, file_object=fi)
+    
+    # データフレームの形状を確認するコードを実行
+    data_thread = execute_code(
+        process_id=process_id,
+        thread_id=0,
+        sandbox=sandbox,
+        user_request=user_request,
+        code="print(df.shape)",  # 実行するPythonコード
+    )
+    
+    # 実行結果をログに出力
+    logger.info(data_thread.model_dump())
 
     # LLMを使用してコードの実行結果をレビュー
     # ユーザーの要求、データの概要、実行結果を基にレビューを生成
@@ -92,4 +93,8 @@ def main() -> None:
 
 if __name__ == "__main__":
     # スクリプトが直接実行された場合のみmain関数を呼び出す
-    main()
+    try:
+        main()
+    finally:
+        # 実行が終わったら、プロセスの終了を待たずに共有のSandboxを破棄する
+        close_sandbox()
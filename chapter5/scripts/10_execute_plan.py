@@ -11,15 +11,13 @@
 4. 実行結果をファイルとして保存
 """
 
+import asyncio
 import base64
-import io
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 from loguru import logger
-from PIL import Image
 
 
 # src 下のファイルを読み込むために、sys.path にパスを追加
@@ -27,14 +25,70 @@ from PIL import Image
 root_dir = Path(__file__).resolve().parents[1]
 sys.path.append(str(root_dir))
 
-from scripts.programmer import programmer_node
-from src.models import Plan
+from scripts.programmer import iter_task_results
+from src.models import Plan, Task
 from src.modules import (
     describe_dataframe,
     generate_plan,
+    open_data_file,
 )
 
 
+def _write_file(item: tuple[str, bytes | str]) -> None:
+    """(保存先のパス, 内容)を受け取り、内容がバイト列ならバイナリ、文字列ならテキストとして保存"""
+    path, content = item
+    if isinstance(content, bytes):
+        Path(path).write_bytes(content)
+    else:
+        Path(path).write_text(content)
+
+
+async def _execute_and_save(
+    data_file: str,
+    tasks: list[Task],
+    data_info: str,
+    output_dir: str,
+    executor: ThreadPoolExecutor,
+) -> list[Future[None]]:
+    """
+    各タスクを並行して実行し、結果が揃ったタスクから順にファイルの書き込みを始める
+    
+    全てのタスクの完了を待たずに書き込みを始めるため、時間のかかるタスクの実行中に
+    完了したタスクの結果を保存できる。
+    
+    Returns:
+        list[Future[None]]: ファイルの書き込みのFutureのリスト
+    """
+    futures: list[Future[None]] = []
+    # タスクのインデックス順に、保存するファイルのパスと内容を集めて書き込む
+    async for _, data_threads in iter_task_results(
+        data_file=data_file,
+        tasks=tasks,
+        # model="o3-mini-2025-01-31",  # コメントアウトされたモデル
+        model="gpt-4o-2024-11-20",  # 使用するLLMモデル
+        data_info=data_info,  # データフレームの概要情報
+    ):
+        data_thread = data_threads[-1]  # 最後の（成功した）スレッドを取得
+        output_file = f"{output_dir}/{data_thread.process_id}_{data_thread.thread_id}."
+        
+        if data_thread.is_completed:
+            # タスクが完了している場合、結果をファイルとして保存
+            items: list[tuple[str, bytes | str]] = []
+            for i, res in enumerate(data_thread.results):
+                if res["type"] == "png":
+                    # PNG画像の場合、Base64デコードしたバイト列をそのまま画像ファイルとして保存
+                    # （PNGとして読み込み直して再エンコードする必要はない）
+                    items.append((f"{output_file}_{i}.png", base64.b64decode(res["content"])))
+                else:
+                    # テキストの場合、テキストファイルとして保存
+                    items.append((f"{output_file}_{i}.txt", res["content"]))
+            futures.extend(executor.submit(_write_file, item) for item in items)
+        else:
+            # タスクが完了していない場合、警告を出力
+            logger.warning(f"{data_thread.user_request=} is not completed.")
+    return futures
+
+
 def main() -> None:
     """
     メイン処理
@@ -53,9 +107,11 @@ def main() -> None:
     
     # 計画生成フェーズ
     # CSVファイルを読み込み、データフレームの概要情報を取得
-    with open(data_file, "rb") as fi:
-        file_object = io.BytesIO(fi.read())
-    data_info = describe_dataframe(file_object=file_object, template_file=template_file)
+    # ファイルはメモリにコピーせず、mmapでOSのページキャッシュから直接読み込む（空のファイルはBytesIOで読み込む）
+    with open_data_file(data_file) as file_object:
+        data_info = describe_dataframe(file_object=file_object, template_file=template_file)
+        # 各タスクで使うデータフレームの概要情報も1度だけ作成し、全てのタスクで共有する
+        task_data_info = describe_dataframe(file_object=file_object)
     
     # LLMを使用して分析計画を生成
     response = generate_plan(
@@ -65,45 +121,24 @@ def main() -> None:
     )
     plan: Plan = response.content
 
-    # 各計画の実行フェーズ
-    # ThreadPoolExecutorを使用して複数のタスクを並行実行
-    with ThreadPoolExecutor() as executor:
-        # 各タスクに対してprogrammer_nodeを実行するFutureオブジェクトを作成
-        futures = [
-            executor.submit(
-                programmer_node,
+    # 各計画の実行・保存フェーズ
+    # asyncioを使用して複数のタスクを1つのイベントループで並行実行し、
+    # 完了したタスクの結果から順に保存する
+    # ファイルの書き込みはスレッドプールで並行して行う
+    # （ネットワーク越しのディレクトリなど、書き込みの遅いストレージで1ファイルずつ待たないようにする）
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = asyncio.run(
+            _execute_and_save(
                 data_file=data_file,
-                user_request=task.hypothesis,  # 各タスクの仮説をユーザー要求として使用
-                # model="o3-mini-2025-01-31",  # コメントアウトされたモデル
-                model="gpt-4o-2024-11-20",  # 使用するLLMモデル
-                process_id=f"sample-{idx}",  # プロセスID（タスク識別子）
-                idx=idx,  # タスクのインデックス
+                tasks=plan.tasks,
+                data_info=task_data_info,
+                output_dir=output_dir,
+                executor=executor,
             )
-            for idx, task in enumerate(plan.tasks)  # 計画の各タスクに対して
-        ]
-        # 完了したタスクから順番に結果を取得
-        _results = [future.result() for future in as_completed(futures)]
-
-    # 実行結果の保存フェーズ
-    # タスクのインデックス順にソートして結果を保存
-    for _, data_threads in sorted(_results, key=lambda x: x[0]):
-        data_thread = data_threads[-1]  # 最後の（成功した）スレッドを取得
-        output_file = f"{output_dir}/{data_thread.process_id}_{data_thread.thread_id}."
-        
-        if data_thread.is_completed:
-            # タスクが完了している場合、結果をファイルとして保存
-            for i, res in enumerate(data_thread.results):
-                if res["type"] == "png":
-                    # PNG画像の場合、Base64デコードして画像ファイルとして保存
-                    image = Image.open(BytesIO(base64.b64decode(res["content"])))
-                    image.save(f"{output_file}_{i}.png")
-                else:
-                    # テキストの場合、テキストファイルとして保存
-                    with open(f"{output_file}_{i}.txt", "w") as f:
-                        f.write(res["content"])
-        else:
-            # タスクが完了していない場合、警告を出力
-            logger.warning(f"{data_thread.user_request=} is not completed.")
+        )
+        # 書き込みの完了を待ち、エラーがあれば送出する
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
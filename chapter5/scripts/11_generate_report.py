@@ -13,9 +13,8 @@
 """
 
 import argparse
-import io
+import asyncio
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 
@@ -24,11 +23,12 @@ from pathlib import Path
 root_dir = Path(__file__).resolve().parents[1]
 sys.path.append(str(root_dir))
 
-from scripts.programmer import programmer_node
+from scripts.programmer import execute_tasks
 from src.models import Plan
 from src.modules import (
     describe_dataframe,
     generate_plan,
+    open_data_file,
     generate_report,
 )
 
@@ -59,9 +59,9 @@ def main() -> None:
 
     # 計画生成フェーズ
     # CSVファイルを読み込み、データフレームの概要情報を取得
-    with open(args.data_file, "rb") as fi:
-        file_object = io.BytesIO(fi.read())
-    data_info = describe_dataframe(file_object=file_object)
+    # ファイルはメモリにコピーせず、mmapでOSのページキャッシュから直接読み込む（空のファイルはBytesIOで読み込む）
+    with open_data_file(args.data_file) as file_object:
+        data_info = describe_dataframe(file_object=file_object)
     
     # LLMを使用して分析計画を生成
     response = generate_plan(
@@ -72,28 +72,19 @@ def main() -> None:
     plan: Plan = response.content
 
     # 各計画の実行フェーズ
-    # ThreadPoolExecutorを使用して複数のタスクを並行実行
-    with ThreadPoolExecutor() as executor:
-        # 各タスクに対してprogrammer_nodeを実行するFutureオブジェクトを作成
-        futures = [
-            executor.submit(
-                programmer_node,
-                data_file=args.data_file,
-                user_request=task.hypothesis,  # 各タスクの仮説をユーザー要求として使用
-                model=args.model,  # 使用するLLMモデル
-                process_id=f"sample-{idx}",  # プロセスID（タスク識別子）
-                idx=idx,  # タスクのインデックス
-            )
-            for idx, task in enumerate(plan.tasks)  # 計画の各タスクに対して
-        ]
-        # 完了したタスクから順番に結果を取得
-        _results = [future.result() for future in as_completed(futures)]
+    # asyncioを使用して複数のタスクを1つのイベントループで並行実行
+    _results = asyncio.run(
+        execute_tasks(
+            data_file=args.data_file,
+            tasks=plan.tasks,
+            model=args.model,  # 使用するLLMモデル
+            data_info=data_info,  # 作成済みの概要情報を全てのタスクで共有する
+        )
+    )
 
     # 実行結果の統合フェーズ
-    # 各タスクの最後の（成功した）スレッドを収集
-    process_data_threads = []
-    for _, data_threads in sorted(_results, key=lambda x: x[0]):
-        process_data_threads.append(data_threads[-1])
+    # 各タスクの最後の（成功した）スレッドを収集（execute_tasksはタスクのインデックス順に結果を返す）
+    process_data_threads = [data_threads[-1] for _, data_threads in _results]
 
     # 最終レポート生成フェーズ
     # データの概要、ユーザー要求、実行結果を統合してレポートを生成
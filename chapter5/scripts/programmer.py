@@ -12,18 +12,27 @@
 - 複数回の試行による改善
 """
 
-import io
+import asyncio
+import functools
+import heapq
 import os
+import textwrap
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import ParamSpec, TypeVar
 from e2b_code_interpreter import Sandbox
+import orjson
 from loguru import logger
 from rich import print
 
-from src.models import DataThread
+from src.llms.apis.openai import aclose_async_client
+from src.models import DataThread, Task
 from src.modules import (
-    describe_dataframe,
+    agenerate_code,
+    agenerate_review,
+    describe_data_file,
     execute_code,
-    generate_code,
-    generate_review,
+    read_dataframe_code,
     set_dataframe,
 )
 
@@ -32,6 +41,61 @@ load_dotenv()
 
 model = os.getenv("AZURE_OPENAI_GPT4O-MINI_DEPLOYMENT_NAME", "gpt-4o-mini-2024-07-18")
 
+# 同時に実行するタスク数の上限（LLM APIのレート制限に合わせて環境変数で調整する）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# AUTO_APPROVE_ON_SUCCESS=1 の場合、エラーなくグラフが出力された試行はレビューを省略して完了とする
+AUTO_APPROVE_ON_SUCCESS = os.getenv("AUTO_APPROVE_ON_SUCCESS", "0") == "1"
+
+# 同期APIのSandbox操作を実行するスレッドプール
+# 同時に実行されるタスク数と同じ数だけ用意し、プロセス内の全てのタスクで共有する
+_SANDBOX_EXECUTOR = ThreadPoolExecutor(
+    max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="sandbox"
+)
+
+# 読み込んだ直後のdfを_df0として残しておくコード（試行の間にCSVを読み直さずにdfを元に戻すために使う）
+_SNAPSHOT_DATAFRAME_CODE = "_df0 = df\ndf = _df0.copy()\n"
+
+# 試行の間にSandboxを初期状態に戻すコード
+# 前回の試行で定義された変数（_で始まるものを除く）・出力の履歴・開いたままのグラフを破棄してメモリを解放し、
+# 読み込んだ直後のdfのコピーを作り直す
+# （呼び出し元が渡したSandboxなど、_df0がない場合のみset_dataframeと同じコードでCSVを読み込む）
+_RESET_SANDBOX_CODE = (
+    "%reset -f out\n"
+    "%reset_selective -f .\n"
+    "try:\n"
+    "    import matplotlib.pyplot as plt\n"
+    "    plt.close('all')\n"
+    "except ImportError:\n"
+    "    pass\n"
+    "import gc\n"
+    "gc.collect()\n"
+    "if '_df0' not in globals():\n"
+    + textwrap.indent(read_dataframe_code(), "    ")
+    + "    _df0 = df\n"
+    "import pandas as pd\n"
+    "df = _df0.copy()\n"
+)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+async def _run_sync(func: Callable[P, R], /, *args: P.args, **kwargs: P.kwargs) -> R:
+    """同期関数を共有のスレッドプールで実行し、完了を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_SANDBOX_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def _create_sandbox(data_file: str) -> Sandbox:
+    """E2B Sandboxを起動し、CSVファイルをデータフレームとして読み込む"""
+    sandbox = await _run_sync(Sandbox)
+    with open(data_file, "rb") as fi:
+        await _run_sync(set_dataframe, sandbox=sandbox, file_object=fi)
+    await _run_sync(sandbox.run_code, _SNAPSHOT_DATAFRAME_CODE)
+    return sandbox
+
+
 def programmer_node(
     data_file: str,
     user_request: str,
@@ -39,6 +103,8 @@ def programmer_node(
     model: str = model,
     n_trial: int = 3,
     idx: int = 0,
+    sandbox: Sandbox | None = None,
+    data_info: str | None = None,
 ) -> tuple[int, list[DataThread]]:
     """
     プログラマーノードのメイン処理
@@ -53,45 +119,94 @@ def programmer_node(
         model: 使用するLLMモデル名
         n_trial: 最大試行回数（デフォルト: 3回）
         idx: タスクのインデックス
+        sandbox: 使用するE2B Sandbox（data_fileをset_dataframeで読み込み済みのもの。
+            省略時は新しく作成し、終了時に破棄する）
+        data_info: データフレームの概要情報（省略時はdata_fileから作成する）
         
     Returns:
         tuple[int, list[DataThread]]: タスクインデックスと実行結果のリスト
     """
+    async def run() -> tuple[int, list[DataThread]]:
+        try:
+            return await aprogrammer_node(
+                data_file=data_file,
+                user_request=user_request,
+                process_id=process_id,
+                model=model,
+                n_trial=n_trial,
+                idx=idx,
+                sandbox=sandbox,
+                data_info=data_info,
+            )
+        finally:
+            # このイベントループで作成したLLMクライアントの接続を、ループの終了前に閉じる
+            await aclose_async_client()
+
+    return asyncio.run(run())
+
+
+async def aprogrammer_node(
+    data_file: str,
+    user_request: str,
+    process_id: str,
+    model: str = model,
+    n_trial: int = 3,
+    idx: int = 0,
+    sandbox: Sandbox | None = None,
+    data_info: str | None = None,
+) -> tuple[int, list[DataThread]]:
+    """
+    programmer_nodeの非同期版
+    
+    LLMの呼び出しはAsyncOpenAIで行い、同期APIのSandbox操作は別スレッドで実行するため、
+    複数のタスクを1つのイベントループで並行して実行できる。引数と戻り値はprogrammer_nodeと同じ。
+    """
     # データフレームの概要情報を取得
-    template_file = "src/prompts/describe_dataframe.jinja"
-    with open(data_file, "rb") as fi:
-        file_object = io.BytesIO(fi.read())
-    data_info = describe_dataframe(file_object=file_object, template_file=template_file)
+    # 呼び出し元で作成済みの場合はそれを使い、なければファイルごとにキャッシュされた概要情報を使う
+    if data_info is None:
+        data_info = describe_data_file(data_file, template_file="src/prompts/describe_dataframe.jinja")
     
     # 実行結果を格納するリスト
     data_threads: list[DataThread] = []
+    # 先行生成した次の試行のコード（レビュー結果が出る前に生成を始めたもの）
+    speculative_code: asyncio.Task | None = None
     
     # E2B Sandboxを使用してコードを実行
-    with Sandbox() as sandbox:
-        # CSVファイルをデータフレームとしてSandboxに読み込み
-        with open(data_file, "rb") as fi:
-            set_dataframe(sandbox=sandbox, file_object=io.BytesIO(fi.read()))
-        
+    # Sandboxの起動とCSVのアップロードには数秒かかるため、渡された場合はそれを使い回す（呼び出し元が破棄する）
+    owns_sandbox = sandbox is None
+    if owns_sandbox:
+        # Sandboxを起動し、CSVファイルをデータフレームとしてSandboxに読み込み
+        sandbox = await _create_sandbox(data_file)
+    try:
         # 最大n_trial回まで試行を繰り返す
         for thread_id in range(n_trial):
+            if thread_id > 0 or not owns_sandbox:
+                # 前回の試行（渡されたSandboxの場合は前のタスク）の状態を消してから、読み込んだ直後のdfに戻す
+                # （Sandboxを作り直さずに、各試行を同じ状態から始める）
+                await _run_sync(sandbox.run_code, _RESET_SANDBOX_CODE)
+            
             # 5.4.1. コード生成フェーズ
             # 前回の実行結果があれば、それを参考にしてコードを改善
-            previous_thread = data_threads[-1] if data_threads else None
-            response = generate_code(
-                data_info=data_info,
-                user_request=user_request,
-                previous_thread=previous_thread,  # 自己修正のための前回結果
-                model=model,
-            )
+            # レビューと並行して先行生成したコードがあれば、それを使う
+            if speculative_code is not None:
+                response = await speculative_code
+                speculative_code = None
+            else:
+                previous_thread = data_threads[-1] if data_threads else None
+                response = await agenerate_code(
+                    data_info=data_info,
+                    user_request=user_request,
+                    previous_thread=previous_thread,  # 自己修正のための前回結果
+                    model=model,
+                )
             program = response.content
             
             # programを辞書に変換
             if isinstance(program, str):
                 # 文字列の場合はJSONとしてパース
-                import json
                 try:
-                    program_dict = json.loads(program)
-                except json.JSONDecodeError:
+                    program_dict = orjson.loads(program)
+                except orjson.JSONDecodeError:
                     # JSONでない場合は空の辞書を作成
                     program_dict = {"code": program}
             else:
@@ -101,7 +216,8 @@ def programmer_node(
             # 5.4.2. コード実行フェーズ
             # 辞書からコードを取得
             code = program_dict["code"]
-            data_thread = execute_code(
+            data_thread = await _run_sync(
+                execute_code,
                 sandbox,
                 process_id=process_id,
                 thread_id=thread_id,
@@ -115,8 +231,36 @@ def programmer_node(
             if data_thread.stderr:
                 logger.warning(f"{data_thread.stderr=}")
             
+            # エラーなくグラフが出力された場合は、レビュー（LLMの呼び出し）を省略して完了とする
+            if (
+                AUTO_APPROVE_ON_SUCCESS
+                and not data_thread.error
+                and not data_thread.stderr
+                and any(res["type"] == "png" for res in data_thread.results)
+            ):
+                data_thread.observation = "エラーなくグラフが出力されたため、レビューを省略して完了としました。"
+                data_thread.is_completed = True
+                data_threads.append(data_thread)
+                logger.success(f"{user_request=} (auto-approved)")
+                break
+            
+            # 実行時にエラーが発生した場合はレビューでも未完了と判定される見込みが高いため、
+            # レビューの完了を待たずに、エラー内容を参考にした次の試行のコード生成を始めておく
+            if data_thread.error and thread_id < n_trial - 1:
+                speculative_thread = data_thread.model_copy(
+                    update={"observation": f"実行時にエラーが発生しました。\n{data_thread.error}"},
+                )
+                speculative_code = asyncio.create_task(
+                    agenerate_code(
+                        data_info=data_info,
+                        user_request=user_request,
+                        previous_thread=speculative_thread,
+                        model=model,
+                    )
+                )
+            
             # 5.4.3. レビュー生成フェーズ
-            response = generate_review(
+            response = await agenerate_review(
                 user_request=user_request,
                 data_info=data_info,
                 data_thread=data_thread,
@@ -126,10 +270,9 @@ def programmer_node(
             # reviewを辞書に変換
             if isinstance(review, str):
                 # 文字列の場合はJSONとしてパース
-                import json
                 try:
-                    review_dict = json.loads(review)
-                except json.JSONDecodeError:
+                    review_dict = orjson.loads(review)
+                except orjson.JSONDecodeError:
                     # JSONでない場合は空の辞書を作成
                     review_dict = {"observation": review}
             else:
@@ -138,8 +281,8 @@ def programmer_node(
             
             # レビュー結果の詳細をログに出力
             if isinstance(review, dict):
-                import json
-                logger.info(json.dumps(review, indent=4, ensure_ascii=False))
+                # orjsonは日本語をエスケープせずに出力する
+                logger.info(orjson.dumps(review, option=orjson.OPT_INDENT_2).decode())
             else:
                 logger.info(str(review))
             
@@ -157,6 +300,112 @@ def programmer_node(
                 logger.success(f"{code=}")
                 logger.success(f"{review_dict["observation"]=}")
                 break
+    finally:
+        # 先行生成したコードが不要になった場合は取り消す
+        if speculative_code is not None:
+            speculative_code.cancel()
+        if owns_sandbox:
+            await _run_sync(sandbox.kill)
     
     # タスクインデックスと実行結果のリストを返す
     return idx, data_threads
+
+
+async def iter_task_results(
+    data_file: str,
+    tasks: list[Task],
+    model: str,
+    data_info: str,
+    max_concurrency: int = LLM_MAX_CONCURRENCY,
+) -> AsyncIterator[tuple[int, list[DataThread]]]:
+    """
+    計画の各タスクに対してprogrammer_nodeを並行して実行し、結果をタスクのインデックス順に返す
+    
+    全てのタスクの完了を待たずに、先頭から順に結果が揃ったものから返すため、
+    呼び出し元は時間のかかるタスクの完了を待つ間に、完了したタスクの結果を処理できる。
+    
+    同時に実行するタスク数だけE2B Sandboxを起動してCSVファイルを読み込んでおき、
+    タスク間で使い回す（タスクごとにSandboxの起動とCSVのアップロードを行わない）。
+    
+    Args:
+        data_file: 分析対象のCSVファイル
+        tasks: 計画のタスクのリスト
+        model: 使用するLLMモデル名
+        data_info: データフレームの概要情報（全てのタスクで共有する）
+        max_concurrency: 同時に実行するタスク数の上限
+        
+    Yields:
+        tuple[int, list[DataThread]]: タスクインデックスと実行結果のリスト
+    """
+    # Sandboxのプール（空いているSandboxがなければ、他のタスクが返却するまで待つ）
+    sandboxes = await asyncio.gather(
+        *(_create_sandbox(data_file) for _ in range(min(max_concurrency, len(tasks))))
+    )
+    pool: asyncio.Queue[Sandbox] = asyncio.Queue()
+    for sandbox in sandboxes:
+        pool.put_nowait(sandbox)
+
+    async def run_task(idx: int, task: Task) -> tuple[int, list[DataThread]]:
+        sandbox = await pool.get()
+        try:
+            return await aprogrammer_node(
+                data_file=data_file,
+                user_request=task.hypothesis,  # 各タスクの仮説をユーザー要求として使用
+                model=model,
+                process_id=f"sample-{idx}",  # プロセスID（タスク識別子）
+                idx=idx,  # タスクのインデックス
+                sandbox=sandbox,
+                data_info=data_info,
+            )
+        finally:
+            pool.put_nowait(sandbox)
+
+    running = [asyncio.create_task(run_task(idx, task)) for idx, task in enumerate(tasks)]
+    try:
+        # 完了したタスクの結果をインデックスの小さい順に取り出せるヒープに入れ、
+        # 次に返すインデックスの結果が揃ったら返す
+        heap: list[tuple[int, list[DataThread]]] = []
+        next_idx = 0
+        for future in asyncio.as_completed(running):
+            heapq.heappush(heap, await future)
+            while heap and heap[0][0] == next_idx:
+                yield heapq.heappop(heap)
+                next_idx += 1
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*(_run_sync(sandbox.kill) for sandbox in sandboxes))
+        # このイベントループで作成したLLMクライアントの接続を、ループの終了前に閉じる
+        await aclose_async_client()
+
+
+async def execute_tasks(
+    data_file: str,
+    tasks: list[Task],
+    model: str,
+    data_info: str,
+    max_concurrency: int = LLM_MAX_CONCURRENCY,
+) -> list[tuple[int, list[DataThread]]]:
+    """
+    計画の各タスクに対してprogrammer_nodeを並行して実行し、全てのタスクの完了を待つ
+    
+    Args:
+        data_file: 分析対象のCSVファイル
+        tasks: 計画のタスクのリスト
+        model: 使用するLLMモデル名
+        data_info: データフレームの概要情報（全てのタスクで共有する）
+        max_concurrency: 同時に実行するタスク数の上限
+        
+    Returns:
+        list[tuple[int, list[DataThread]]]: タスクインデックス順の、タスクインデックスと実行結果のリスト
+    """
+    return [
+        result
+        async for result in iter_task_results(
+            data_file=data_file,
+            tasks=tasks,
+            model=model,
+            data_info=data_info,
+            max_concurrency=max_concurrency,
+        )
+    ]
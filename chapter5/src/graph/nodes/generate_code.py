@@ -1,10 +1,8 @@
-import io
-
 from langgraph.types import Command
 from loguru import logger
 
 from src.graph.models.programmer_state import DataThread, ProgrammerState
-from src.modules import describe_dataframe, generate_code
+from src.modules import describe_data_file, generate_code
 
 
 TEMPLATE_FILE = "src/prompts/generate_code.jinja"
@@ -16,10 +14,8 @@ def generate_code_node(state: ProgrammerState) -> dict:
     request = state["user_request"]
     if len(threads) > 0:
         request += "\n" + threads[-1].observation
-    with open(state["data_file"], "rb") as fi:
-        file_object = io.BytesIO(fi.read())
-    data_info = describe_dataframe(
-        file_object=file_object,
+    data_info = describe_data_file(
+        state["data_file"],
         template_file=TEMPLATE_FILE,
     )
     response = generate_code(
@@ -1,7 +1,15 @@
+import asyncio
+import hashlib
 import os
+import threading
+from functools import lru_cache
+from pathlib import Path
 
+import httpx
+import orjson
 from dotenv import load_dotenv
-from openai import AzureOpenAI, OpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
+from openai.types.chat import ChatCompletion
 from pydantic import BaseModel
 
 from src.llms.models.llm_response import LLMResponse
@@ -9,6 +17,36 @@ from src.llms.models.llm_response import LLMResponse
 
 load_dotenv("/home/ryoyamasuda/Documents/genai-agent-advanced-book/chapter5/.env")
 
+# 使用するAPI（openai / azure）とデフォルトのモデル名はインポート時に1度だけ決定する
+_IS_AZURE = os.getenv("API_PROVIDER", "openai").lower() == "azure"
+if _IS_AZURE:
+    # Azure OpenAIの場合、デプロイメント名を使用
+    _DEFAULT_MODEL = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+    # 設定の不備はLLMを呼び出す時ではなく、インポート時にエラーとする
+    if not _DEFAULT_MODEL:
+        raise ValueError("Azure OpenAI設定が不完全です。AZURE_OPENAI_DEPLOYMENT_NAMEを設定してください。")
+else:
+    # OpenAIの場合、環境変数またはデフォルト値を使用
+    _DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06")
+
+# 並列実行される各タスクから同時に呼び出されても、接続を使い回せるだけの接続数を確保する
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+# 非同期クライアント用（1つのイベントループから並行して送信するリクエスト数の上限）
+_ASYNC_HTTP_LIMITS = httpx.Limits(max_connections=32)
+# イベントループごとの非同期クライアント（aclose_async_clientで閉じるまで使い回す）
+_ASYNC_CLIENTS: dict[asyncio.AbstractEventLoop, AsyncOpenAI | AsyncAzureOpenAI] = {}
+
+# レスポンスキャッシュはLLM_CACHE=1 またはLLM_CACHE_DIR（保存先）を設定した場合のみ有効にする
+# 有効な場合、temperature=0 を指定した呼び出しでは、同じモデル・メッセージ・出力形式へのレスポンスをキャッシュし、APIを呼ばずに返す
+# （temperatureを指定しない呼び出しは毎回異なる出力を期待するためキャッシュしない）
+_CACHE_ENABLED = (
+    os.getenv("LLM_CACHE", "").lower() in ("1", "true", "yes") or bool(os.getenv("LLM_CACHE_DIR"))
+)
+_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR") or "~/.cache/genai_llm").expanduser()
+_MEMORY_CACHE: dict[str, dict] = {}
+_MEMORY_CACHE_MAXSIZE = 256
+_MEMORY_CACHE_LOCK = threading.Lock()
+
 # https://openai.com/api/pricing/ を参照されたい
 COST = {
     "o3-mini-2025-01-31": {
@@ -24,13 +62,15 @@ COST = {
         "output": 0.600 / 1_000_000,
     },
 }
+# モデルごとの(入力, 出力)の単価
+_COST_RATES: dict[str, tuple[float, float]] = {k: (v["input"], v["output"]) for k, v in COST.items()}
+# コストはLLM_TRACK_COST=1 の場合のみ計算する（計算しない場合、LLMResponse.costはNoneのまま）
+_TRACK_COST = os.getenv("LLM_TRACK_COST", "").lower() in ("1", "true", "yes")
 
 
-def _get_client():
-    """OpenAIまたはAzure OpenAIクライアントを取得"""
-    api_provider = os.getenv("API_PROVIDER", "openai").lower()
-    
-    if api_provider == "azure":
+def _client_kwargs() -> dict:
+    """OpenAIまたはAzure OpenAIクライアントの接続設定を取得"""
+    if _IS_AZURE:
         # Azure OpenAI設定
         api_key = os.getenv("AZURE_OPENAI_API_KEY")
         endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
@@ -39,11 +79,7 @@ def _get_client():
         if not api_key or not endpoint:
             raise ValueError("Azure OpenAI設定が不完全です。AZURE_OPENAI_API_KEYとAZURE_OPENAI_ENDPOINTを設定してください。")
         
-        return AzureOpenAI(
-            api_key=api_key,
-            azure_endpoint=endpoint,
-            api_version=api_version,
-        )
+        return {"api_key": api_key, "azure_endpoint": endpoint, "api_version": api_version}
     else:
         # OpenAI設定
         api_key = os.getenv("OPENAI_API_KEY")
@@ -52,73 +88,229 @@ def _get_client():
         if not api_key:
             raise ValueError("OpenAI API設定が不完全です。OPENAI_API_KEYを設定してください。")
         
-        return OpenAI(
-            api_key=api_key,
-            base_url=base_url,
+        return {"api_key": api_key, "base_url": base_url}
+
+
+@lru_cache(maxsize=1)
+def _get_client() -> OpenAI | AzureOpenAI:
+    """OpenAIまたはAzure OpenAIクライアントを取得（初回のみ作成し、以降は同じクライアントを返す）"""
+    client_class = AzureOpenAI if _IS_AZURE else OpenAI
+    return client_class(**_client_kwargs(), http_client=httpx.Client(limits=_HTTP_LIMITS))
+
+
+def _get_async_client() -> AsyncOpenAI | AsyncAzureOpenAI:
+    """非同期版のクライアントを取得（同じイベントループの中では同じクライアントを返す）"""
+    # 非同期クライアントの接続は作成したイベントループでしか使えないため、ループごとに作成する
+    loop = asyncio.get_running_loop()
+    # aclose_async_clientを呼ばずに終了したイベントループのクライアントは、もう使えないため破棄する
+    for closed_loop in [other for other in _ASYNC_CLIENTS if other.is_closed()]:
+        _ASYNC_CLIENTS.pop(closed_loop, None)
+    client = _ASYNC_CLIENTS.get(loop)
+    if client is None:
+        client_class = AsyncAzureOpenAI if _IS_AZURE else AsyncOpenAI
+        client = client_class(**_client_kwargs(), http_client=httpx.AsyncClient(limits=_ASYNC_HTTP_LIMITS))
+        _ASYNC_CLIENTS[loop] = client
+    return client
+
+
+async def aclose_async_client() -> None:
+    """
+    実行中のイベントループで作成した非同期クライアントを閉じる
+
+    asyncio.runでイベントループを終了する前に呼び出し、開いたままの接続を閉じる。
+    （閉じた後に再びLLMを呼び出した場合は、新しいクライアントが作成される）
+    """
+    client = _ASYNC_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def _cache_key(
+    messages: list,
+    model: str,
+    response_format: type[BaseModel] | None,
+) -> str:
+    """モデル・メッセージ・出力形式からキャッシュのキーを作成"""
+    # 出力形式はクラス名ではなくスキーマで区別する（フィールドが変わったら古いキャッシュを使わない）
+    payload = {
+        "model": model,
+        "messages": messages,
+        "response_format": response_format.model_json_schema() if response_format else None,
+    }
+    # orjsonはbytesを直接返すため、そのままハッシュ値を計算できる
+    data = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _get_cache_key(
+    messages: list,
+    model: str,
+    response_format: type[BaseModel] | None,
+    temperature: float | None,
+) -> str | None:
+    """キャッシュが有効で、キャッシュを使う呼び出し（temperature=0）の場合のみキャッシュのキーを返す"""
+    if not _CACHE_ENABLED or temperature != 0:
+        return None
+    return _cache_key(messages, model, response_format)
+
+
+def _sampling_kwargs(temperature: float | None) -> dict:
+    """temperatureが指定された場合のみAPIに渡す（未指定の場合はAPIのデフォルト値を使う）"""
+    return {} if temperature is None else {"temperature": temperature}
+
+
+def _load_cache(key: str) -> dict | None:
+    """メモリ上のキャッシュ、なければディスク上のキャッシュからレスポンスを取得"""
+    with _MEMORY_CACHE_LOCK:
+        if key in _MEMORY_CACHE:
+            return _MEMORY_CACHE[key]
+    try:
+        entry = orjson.loads((_CACHE_DIR / f"{key}.json").read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    _store_memory_cache(key, entry)
+    return entry
+
+
+def _store_memory_cache(key: str, entry: dict) -> None:
+    """レスポンスをメモリ上のキャッシュに保存"""
+    with _MEMORY_CACHE_LOCK:
+        # 上限に達した場合は最も古いものから削除する
+        if key not in _MEMORY_CACHE and len(_MEMORY_CACHE) >= _MEMORY_CACHE_MAXSIZE:
+            _MEMORY_CACHE.pop(next(iter(_MEMORY_CACHE)), None)
+        _MEMORY_CACHE[key] = entry
+
+
+def _save_cache(key: str, entry: dict) -> None:
+    """レスポンスをメモリ上とディスク上のキャッシュに保存"""
+    _store_memory_cache(key, entry)
+    _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # 並列実行中に書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+    tmp_path = _CACHE_DIR / f"{key}.{threading.get_ident()}.tmp"
+    tmp_path.write_bytes(orjson.dumps(entry))
+    tmp_path.replace(_CACHE_DIR / f"{key}.json")
+
+
+def _load_cached_response(messages: list, cache_key: str | None) -> LLMResponse | None:
+    """キャッシュにあるレスポンスを取得（コストは発生しないので0とする）"""
+    if cache_key is None or (entry := _load_cache(cache_key)) is None:
+        return None
+    response = LLMResponse(
+        messages=messages,
+        content=entry["content"],
+        model=entry["model"],
+        created_at=entry["created"],
+        input_tokens=entry["usage"]["input_tokens"],
+        output_tokens=entry["usage"]["output_tokens"],
+    )
+    response.cost = 0.0
+    return response
+
+
+def _to_response(
+    messages: list,
+    model: str,
+    completion: ChatCompletion,
+    cache_key: str | None,
+) -> LLMResponse:
+    """APIのレスポンスからLLMResponseを作成し、キャッシュに保存"""
+    content = completion.choices[0].message.content or ""
+    
+    usage = completion.usage
+    input_tokens = usage.prompt_tokens if usage else 0
+    output_tokens = usage.completion_tokens if usage else 0
+    
+    # コスト計算（Azure OpenAIの場合、料金表にないモデルの場合はコスト計算をスキップ）
+    total_cost = None
+    if _TRACK_COST:
+        rate = None if _IS_AZURE else _COST_RATES.get(model)
+        total_cost = input_tokens * rate[0] + output_tokens * rate[1] if rate else 0.0
+    
+    if cache_key is not None:
+        _save_cache(
+            cache_key,
+            {
+                "content": content,
+                "model": completion.model,
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+                "created": completion.created,
+            },
         )
 
+    response = LLMResponse(
+        messages=messages,
+        content=content,
+        model=completion.model,
+        created_at=completion.created,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+    )
+    response.cost = total_cost
+    return response
+
 
 def generate_response(
     messages: list,
     model: str | None = None,
     response_format: type[BaseModel] | None = None,
+    temperature: float | None = None,
 ) -> LLMResponse:
-    client = _get_client()
-    
-    # モデル名の決定
-    api_provider = os.getenv("API_PROVIDER", "openai").lower()
-    if api_provider == "azure":
-        # Azure OpenAIの場合、デプロイメント名を使用
-        if model is None:
-            model = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-            if not model:
-                raise ValueError("Azure OpenAI設定が不完全です。AZURE_OPENAI_DEPLOYMENT_NAMEを設定してください。")
-    else:
-        # OpenAIの場合、環境変数またはデフォルト値を使用
-        if model is None:
-            model = os.getenv("OPENAI_MODEL", "gpt-4o-2024-08-06")
+    model = model or _DEFAULT_MODEL
     
+    # キャッシュにあればAPIを呼ばずに返す
+    cache_key = _get_cache_key(messages, model, response_format, temperature)
+    if (response := _load_cached_response(messages, cache_key)) is not None:
+        return response
+
     # LLM呼び出し
+    client = _get_client()
     if response_format is None:
         # Chat Completion
         completion = client.chat.completions.create(
             model=model,
-            messages=messages
+            messages=messages,
+            **_sampling_kwargs(temperature),
         )
-        content = completion.choices[0].message.content or ""
     else:
         # Structured Outputs
         completion = client.beta.chat.completions.parse(
             model=model,
             messages=messages,
             response_format=response_format,
+            **_sampling_kwargs(temperature),
         )
-        content = completion.choices[0].message.content or ""
+    return _to_response(messages, model, completion, cache_key)
+
+
+async def agenerate_response(
+    messages: list,
+    model: str | None = None,
+    response_format: type[BaseModel] | None = None,
+    temperature: float | None = None,
+) -> LLMResponse:
+    """generate_responseの非同期版（AsyncOpenAIでLLMを呼び出す）"""
+    model = model or _DEFAULT_MODEL
     
-    # コスト計算（Azure OpenAIの場合はコスト計算をスキップ）
-    usage = completion.usage
-    if usage is not None and api_provider != "azure":
-        # OpenAIの場合のみコスト計算
-        if model in COST:
-            input_cost = usage.prompt_tokens * COST[model]["input"]
-            output_cost = usage.completion_tokens * COST[model]["output"]
-            total_cost = input_cost + output_cost
-        else:
-            total_cost = 0.0
-        input_tokens = usage.prompt_tokens
-        output_tokens = usage.completion_tokens
+    # キャッシュにあればAPIを呼ばずに返す
+    cache_key = _get_cache_key(messages, model, response_format, temperature)
+    if (response := _load_cached_response(messages, cache_key)) is not None:
+        return response
+
+    # LLM呼び出し
+    client = _get_async_client()
+    if response_format is None:
+        # Chat Completion
+        completion = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            **_sampling_kwargs(temperature),
+        )
     else:
-        total_cost = 0.0
-        input_tokens = usage.prompt_tokens if usage else 0
-        output_tokens = usage.completion_tokens if usage else 0
-    
-    response = LLMResponse(
-        messages=messages,
-        content=content,
-        model=completion.model,
-        created_at=completion.created,
-        input_tokens=input_tokens,
-        output_tokens=output_tokens,
-    )
-    response.cost = total_cost
-    return response
+        # Structured Outputs
+        completion = await client.beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=response_format,
+            **_sampling_kwargs(temperature),
+        )
+    return _to_response(messages, model, completion, cache_key)
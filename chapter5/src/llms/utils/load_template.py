@@ -1,9 +1,17 @@
+from functools import lru_cache
 from pathlib import Path
 
 from jinja2 import Environment, FileSystemLoader, Template
 
 
+@lru_cache(maxsize=16)
+def _get_environment(template_dir: Path) -> Environment:
+    # Environmentはコンパイル済みのテンプレートをキャッシュするため、ディレクトリごとに使い回す
+    # （auto_reloadが有効なので、テンプレートファイルを編集した場合は読み直される）
+    return Environment(loader=FileSystemLoader(template_dir), autoescape=True)
+
+
 def load_template(template_file: str) -> Template:
     template_path = Path(template_file)
-    env = Environment(loader=FileSystemLoader(template_path.parent), autoescape=True)
+    env = _get_environment(template_path.parent)
     return env.get_template(template_path.name)
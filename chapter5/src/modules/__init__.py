@@ -1,18 +1,26 @@
-from .describe_dataframe import describe_dataframe
+from .describe_dataframe import describe_data_file, describe_dataframe, open_data_file
 from .execute_code import execute_code
-from .generate_code import generate_code
+from .generate_code import agenerate_code, generate_code
 from .generate_plan import generate_plan
 from .generate_report import generate_report
-from .generate_review import generate_review
-from .set_dataframe import set_dataframe
+from .generate_review import agenerate_review, generate_review
+from .sandbox import close_sandbox, get_sandbox
+from .set_dataframe import read_dataframe_code, set_dataframe
 
 
 __all__ = [
+    "agenerate_code",
+    "agenerate_review",
+    "close_sandbox",
+    "describe_data_file",
     "describe_dataframe",
     "execute_code",
     "generate_code",
     "generate_plan",
     "generate_report",
     "generate_review",
+    "get_sandbox",
+    "open_data_file",
+    "read_dataframe_code",
     "set_dataframe",
 ]
@@ -1,24 +1,99 @@
+import hashlib
 import io
+import mmap
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
 
 import pandas as pd
 
 from src.llms.utils import load_template
 
+# (CSVの内容のハッシュ値, テンプレートファイル, テンプレートの更新時刻) -> 概要情報
+_DESCRIBE_CACHE: dict[tuple[bytes, str, float], str] = {}
+_DESCRIBE_CACHE_MAXSIZE = 32
+# この行数を超えるデータでは、数値列だけの統計情報を作成する
+_LARGE_DATAFRAME_ROWS = 100_000
+
 
 def describe_dataframe(
-    file_object: io.BytesIO,
+    file_object: io.BytesIO | mmap.mmap,
     template_file: str = "src/prompts/describe_dataframe.jinja",
 ) -> str:
+    # 同じCSV・同じテンプレートの概要情報は一度だけ作成し、以降はキャッシュを返す
+    # （並列実行される各タスクや自己修正のループで同じ処理を繰り返さないようにする）
+    # BytesIO・mmapのどちらも、内容をコピーせずにハッシュ値を計算する
+    data = file_object.getbuffer() if isinstance(file_object, io.BytesIO) else file_object
+    key = (
+        hashlib.blake2b(data, digest_size=16).digest(),
+        template_file,
+        os.path.getmtime(template_file),
+    )
+    del data
+    if key in _DESCRIBE_CACHE:
+        return _DESCRIBE_CACHE[key]
+
     # CSVファイルを読み込み、データフレームを作成
-    df = pd.read_csv(file_object)
+    # pyarrowエンジンはマルチスレッドで読み込むため、デフォルトのCエンジンより高速
+    # pyarrowで読み込めない形式の場合はCエンジンで読み込む
+    try:
+        file_object.seek(0)
+        df = pd.read_csv(file_object, engine="pyarrow")
+    except Exception:
+        file_object.seek(0)
+        df = pd.read_csv(file_object, engine="c", low_memory=False, cache_dates=True)
     # データフレームの概要情報を取得
     buf = io.StringIO()
     df.info(buf=buf)
     df_info = buf.getvalue()
     # データフレーム情報を構築して返す
+    # サンプルはランダムに抽出せず、先頭3行と末尾2行を使う（毎回同じ内容になる）
+    df_sample = pd.concat([df.head(3), df.tail(2)])
+    # 大きなデータでは、文字列の列の集計を省略する（数値の列が1つもない場合は全ての列を集計する）
+    include = (
+        "number"
+        if len(df) > _LARGE_DATAFRAME_ROWS and df.select_dtypes("number").shape[1] > 0
+        else None
+    )
     template = load_template(template_file)
-    return template.render(
+    data_info = template.render(
         df_info=df_info,
-        df_sample=df.sample(5).to_markdown(),
-        df_describe=df.describe().to_markdown(),
+        df_sample=df_sample.to_markdown(),
+        df_describe=df.describe(include=include).to_markdown(),
+        # LLMに示すコードを、実際にサンプルと統計情報を作成した方法に合わせる
+        df_sample_expr="pd.concat([df.head(3), df.tail(2)])",
+        df_describe_expr="df.describe(include='number')" if include else "df.describe()",
     )
+
+    # キャッシュが上限に達した場合は最も古いものから削除する
+    if len(_DESCRIBE_CACHE) >= _DESCRIBE_CACHE_MAXSIZE:
+        _DESCRIBE_CACHE.pop(next(iter(_DESCRIBE_CACHE)), None)
+    _DESCRIBE_CACHE[key] = data_info
+    return data_info
+
+
+@contextmanager
+def open_data_file(path: str) -> Iterator[io.BytesIO | mmap.mmap]:
+    # ファイルはメモリにコピーせず、mmapでOSのページキャッシュから直接読み込む
+    # 空のファイルはmmapできないため、その場合は内容をそのままBytesIOに読み込む
+    with open(path, "rb") as fi:
+        if os.path.getsize(path) == 0:
+            yield io.BytesIO(fi.read())
+            return
+        with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+@lru_cache(maxsize=8)
+def _describe_data_file_cached(path: str, mtime: float, size: int, template_file: str) -> str:
+    # mtimeとsizeはキャッシュのキーとしてのみ使用する（ファイルが更新されたら読み直す）
+    with open_data_file(path) as file_object:
+        return describe_dataframe(file_object=file_object, template_file=template_file)
+
+
+def describe_data_file(data_file: str, template_file: str = "src/prompts/describe_dataframe.jinja") -> str:
+    # ファイルのパス・更新時刻・サイズが同じ間は、ファイルを読み込まずにキャッシュした概要情報を返す
+    # （計画の各タスクで同じCSVファイルを何度も読み込まないようにする）
+    stat = os.stat(data_file)
+    return _describe_data_file_cached(data_file, stat.st_mtime, stat.st_size, template_file)
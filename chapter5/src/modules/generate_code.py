@@ -7,6 +7,7 @@ LLMを使用してユーザーの要求に基づいたコードを生成し、
 """
 
 import os
+import re
 from src.llms.apis import openai
 from src.llms.models import LLMResponse
 from src.llms.utils import load_template
@@ -19,36 +20,67 @@ load_dotenv("/home/ryoyamasuda/Documents/genai-agent-advanced-book/chapter5/.env
 # Azure OpenAIのモデル名を取得, OpenAIの場合はデフォルト値を使用
 model = os.getenv("AZURE_OPENAI_GPT4O-MINI_DEPLOYMENT_NAME", "gpt-4o-mini-2024-07-18")
 
-def generate_code(
+# デフォルトのプロンプトテンプレートはインポート時に1度だけ読み込み、呼び出しごとに読み直さない
+DEFAULT_TEMPLATE_FILE = "src/prompts/generate_code.jinja"
+_TEMPLATE = load_template(DEFAULT_TEMPLATE_FILE)
+
+# 前回の実行結果（標準出力・標準エラー・エラー）のうち、LLMに渡す末尾の文字数
+_MAX_OUTPUT_CHARS = 2048
+# トレースバックの各フレームの先頭行（通常のPython、Jupyterカーネルのライブラリ内とセル内の形式）
+_TRACEBACK_FRAME_RE = re.compile(
+    r'^[ \t]*(?:File ".*", line \d+|File .+:\d+, in |(Cell In\[\d+\], line \d+))', re.MULTILINE
+)
+# Jupyterカーネルのトレースバックに含まれる色付けのエスケープシーケンス
+_ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def _trim(text: str, n: int = _MAX_OUTPUT_CHARS) -> str:
+    """末尾のn文字だけを残す（エラーの内容は末尾に出力されるため）"""
+    return text if len(text) <= n else "..." + text[-n:]
+
+
+def _last_traceback(text: str) -> str:
+    """
+    トレースバックが含まれる場合、最後のフレームと例外のメッセージだけを取り出す
+
+    Jupyterカーネルのトレースバックでは、最後のフレームはライブラリの中であることが多いため、
+    生成したコードを修正できるよう、最後のセル内のフレームと例外のメッセージを取り出す。
+    """
+    text = _ANSI_ESCAPE_RE.sub("", text)
+    if "Traceback" not in text:
+        return text
+    frames = list(_TRACEBACK_FRAME_RE.finditer(text))
+    if not frames:
+        return text
+    cell_frames = [i for i, frame in enumerate(frames) if frame.group(1)]
+    if not cell_frames or cell_frames[-1] == len(frames) - 1:
+        return "Traceback (most recent call last):\n" + text[frames[-1].start():]
+    # 最後のセル内のフレームから次のフレームの直前までと、末尾の例外のメッセージ
+    i = cell_frames[-1]
+    cell_frame = text[frames[i].start():frames[i + 1].start()].rstrip()
+    exception = text.rstrip().rsplit("\n\n", 1)[-1]
+    return f"Traceback (most recent call last):\n{cell_frame}\n...\n{exception}"
+
+
+def _build_messages(
     data_info: str,
     user_request: str,
     remote_save_dir: str = "outputs/process_id/id",
     previous_thread: DataThread | None = None,
-    model: str = model,
-    template_file: str = "src/prompts/generate_code.jinja",
-) -> LLMResponse:
-    """
-    データ分析用のPythonコードを生成する
-    
-    Args:
-        data_info: データフレームの概要情報（describe_dataframeの出力）
-        user_request: ユーザーからの分析要求
-        remote_save_dir: リモート保存ディレクトリのパス
-        previous_thread: 前回の実行結果（エラー修正時に使用）
-        model: 使用するLLMモデル名
-        template_file: プロンプトテンプレートファイルのパス
-        
-    Returns:
-        LLMResponse: 生成されたコードとメタデータを含むレスポンス
-    """
+    template_file: str = DEFAULT_TEMPLATE_FILE,
+) -> list:
+    """generate_code・agenerate_codeに渡すメッセージを構築する"""
     # プロンプトテンプレートを読み込み、データ情報と保存先を設定
-    template = load_template(template_file)
+    # デフォルト以外のテンプレートが指定された場合のみ読み込む
+    template = _TEMPLATE if template_file == DEFAULT_TEMPLATE_FILE else load_template(template_file)
     system_message = template.render(
         data_info=data_info,
         remote_save_dir=remote_save_dir,
     )
     
     # 基本的なメッセージ構成：システムプロンプト + ユーザー要求
+    # 変化しない内容（システムプロンプト）を先頭に、試行ごとに変わる内容を末尾に置き、
+    # プロバイダーのプロンプトキャッシュ（先頭一致）が効くようにする
     messages = [
         {"role": "system", "content": system_message},
         {"role": "user", "content": f"タスク要求: {user_request}"},
@@ -61,15 +93,18 @@ def generate_code(
         if previous_thread.code:
             messages.append({"role": "assistant", "content": previous_thread.code})
         
-        # 前回の実行結果（標準出力・標準エラー）を追加
+        # 前回の実行結果（標準出力・標準エラー・エラー）を1つのメッセージにまとめて追加
         # エラーメッセージや出力結果から問題点を特定し、修正できる
+        # 試行ごとに送る内容を減らすため、末尾だけを残し、トレースバックは最後のフレームだけにする
+        # （E2B Sandboxでは、実行時エラーのトレースバックは標準エラーではなくerrorに入る）
+        sections = []
         if previous_thread.stdout and previous_thread.stderr:
-            messages.extend(
-                [
-                    {"role": "system", "content": f"stdout: {previous_thread.stdout}"},
-                    {"role": "system", "content": f"stderr: {previous_thread.stderr}"},
-                ],
-            )
+            sections.append(f"[Previous stdout]\n{_trim(previous_thread.stdout)}")
+            sections.append(f"[Previous stderr]\n{_trim(_last_traceback(previous_thread.stderr))}")
+        if previous_thread.error:
+            sections.append(f"[Previous error]\n{_trim(_last_traceback(previous_thread.error))}")
+        if sections:
+            messages.append({"role": "user", "content": "\n".join(sections)})
         
         # 前回の観測結果（レビュー結果など）を追加
         # 人間によるフィードバックがあれば、それを反映してコードを再生成
@@ -81,10 +116,71 @@ def generate_code(
                 },
             )
     
+    return messages
+
+
+def generate_code(
+    data_info: str,
+    user_request: str,
+    remote_save_dir: str = "outputs/process_id/id",
+    previous_thread: DataThread | None = None,
+    model: str = model,
+    template_file: str = DEFAULT_TEMPLATE_FILE,
+    temperature: float | None = None,
+) -> LLMResponse:
+    """
+    データ分析用のPythonコードを生成する
+    
+    Args:
+        data_info: データフレームの概要情報（describe_dataframeの出力）
+        user_request: ユーザーからの分析要求
+        remote_save_dir: リモート保存ディレクトリのパス
+        previous_thread: 前回の実行結果（エラー修正時に使用）
+        model: 使用するLLMモデル名
+        template_file: プロンプトテンプレートファイルのパス
+        temperature: サンプリングの温度（省略時はAPIのデフォルト値。0を指定した呼び出しはレスポンスキャッシュの対象になる）
+        
+    Returns:
+        LLMResponse: 生成されたコードとメタデータを含むレスポンス
+    """
+    messages = _build_messages(
+        data_info=data_info,
+        user_request=user_request,
+        remote_save_dir=remote_save_dir,
+        previous_thread=previous_thread,
+        template_file=template_file,
+    )
+    
     # LLMを呼び出してコードを生成
     # Programモデルを使用して構造化された出力（達成条件、実行計画、コード）を取得
     return openai.generate_response(
         messages,
         model=model,
         response_format=Program,
+        temperature=temperature,
+    )
+
+
+async def agenerate_code(
+    data_info: str,
+    user_request: str,
+    remote_save_dir: str = "outputs/process_id/id",
+    previous_thread: DataThread | None = None,
+    model: str = model,
+    template_file: str = DEFAULT_TEMPLATE_FILE,
+    temperature: float | None = None,
+) -> LLMResponse:
+    """generate_codeの非同期版（並行して実行されるタスクから呼び出す）"""
+    messages = _build_messages(
+        data_info=data_info,
+        user_request=user_request,
+        remote_save_dir=remote_save_dir,
+        previous_thread=previous_thread,
+        template_file=template_file,
+    )
+    return await openai.agenerate_response(
+        messages,
+        model=model,
+        response_format=Program,
+        temperature=temperature,
     )
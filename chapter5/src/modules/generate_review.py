@@ -9,7 +9,11 @@ LLMを使用して、実行されたコードの結果をレビューし、
 改善提案を行う役割を担います。
 """
 
+import base64
+import hashlib
+import io
 import os
+from PIL import Image
 from src.llms.apis import openai
 from src.llms.models import LLMResponse
 from src.llms.utils import load_template
@@ -19,14 +23,93 @@ from dotenv import load_dotenv
 load_dotenv()
 model = os.getenv("AZURE_OPENAI_GPT4O-MINI_DEPLOYMENT_NAME", "gpt-4o-mini-2024-07-18")
 
+# デフォルトのプロンプトテンプレートはインポート時に1度だけ読み込み、呼び出しごとに読み直さない
+DEFAULT_TEMPLATE_FILE = "src/prompts/generate_review.jinja"
+_TEMPLATE = load_template(DEFAULT_TEMPLATE_FILE)
+
+# レビューに添付する画像の最大サイズ（縦横のピクセル数）とJPEGの品質
+_IMAGE_MAX_SIZE = (768, 768)
+_IMAGE_JPEG_QUALITY = 80
+
+
+def _to_image_url(content: str) -> str:
+    """Base64形式のPNG画像を縮小・JPEGに変換し、LLMに渡すdata URLを作成する（画像の入力トークンを減らす）"""
+    img = Image.open(io.BytesIO(base64.b64decode(content)))
+    img.thumbnail(_IMAGE_MAX_SIZE)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=_IMAGE_JPEG_QUALITY)
+    return f"data:image/jpeg;base64,{base64.b64encode(buf.getvalue()).decode()}"
+
+
+def _build_messages(
+    data_info: str,
+    user_request: str,
+    data_thread: DataThread,
+    has_results: bool = False,
+    max_images: int = 4,
+    remote_save_dir: str = "outputs/process_id/id",
+    template_file: str = DEFAULT_TEMPLATE_FILE,
+) -> list:
+    """generate_review・agenerate_reviewに渡すメッセージを構築する"""
+    # プロンプトテンプレートを読み込み、システム指示を生成
+    # デフォルト以外のテンプレートが指定された場合のみ読み込む
+    template = _TEMPLATE if template_file == DEFAULT_TEMPLATE_FILE else load_template(template_file)
+    system_instruction = template.render(
+        data_info=data_info,
+        remote_save_dir=remote_save_dir,
+    )
+    
+    # LLMとの会話履歴を構築
+    # システム指示とユーザーの要求は同じタスクの試行間で変わらないため先頭に置き、
+    # プロバイダーのプロンプトキャッシュ（先頭一致）が効くようにする
+    messages = [
+        {"role": "system", "content": system_instruction},  # システム指示
+        {"role": "user", "content": user_request},  # ユーザーの要求
+        {"role": "assistant", "content": data_thread.code},  # 実行されたコード
+    ]
+    
+    # 試行ごとに変わる実行結果（標準出力・標準エラー・結果データ）は、末尾の1つのメッセージにまとめる
+    contents = [
+        {
+            "type": "text",
+            "text": f"stdout: {data_thread.stdout}\nstderr: {data_thread.stderr}",
+        },
+    ]
+    
+    # 結果データがある場合の処理
+    if has_results:
+        # 実行結果をLLMが理解できる形式に変換
+        # 画像は縮小して最大max_images枚まで添付し、同じ内容の画像は1度だけ添付する
+        image_hashes = set()
+        for res in data_thread.results:
+            if res["type"] == "png":
+                image_hash = hashlib.sha256(res["content"].encode()).digest()
+                if len(image_hashes) >= max_images or image_hash in image_hashes:
+                    continue
+                image_hashes.add(image_hash)
+                # PNG画像の場合、縮小したJPEG画像をBase64形式の画像URLとして設定
+                contents.append({"type": "image_url", "image_url": {"url": _to_image_url(res["content"])}})
+            else:
+                # テキストの場合、そのまま設定
+                contents.append({"type": "text", "text": res["content"]})
+    
+    # レビュー要求を追加
+    contents.append({"type": "text", "text": "実行結果に対するフィードバックを提供してください。"})
+    messages.append({"role": "user", "content": contents})
+    
+    return messages
+
+
 def generate_review(
     data_info: str,
     user_request: str,
     data_thread: DataThread,
     has_results: bool = False,
+    max_images: int = 4,
     remote_save_dir: str = "outputs/process_id/id",
     model: str = model,
-    template_file: str = "src/prompts/generate_review.jinja",
+    template_file: str = DEFAULT_TEMPLATE_FILE,
+    temperature: float | None = None,
 ) -> LLMResponse:
     """
     コードの実行結果をレビューし、改善点や完了判定を生成する
@@ -36,9 +119,11 @@ def generate_review(
         user_request: ユーザーの分析要求
         data_thread: 実行されたコードの結果を含むデータスレッド
         has_results: 結果データ（画像・テキスト）を含むかどうか
+        max_images: 添付する画像の最大枚数
         remote_save_dir: リモート保存ディレクトリのパス
         model: 使用するLLMモデル名
         template_file: レビュー生成用のプロンプトテンプレートファイルのパス
+        temperature: サンプリングの温度（省略時はAPIのデフォルト値。0を指定した呼び出しはレスポンスキャッシュの対象になる）
         
     Returns:
         LLMResponse: レビュー結果を含むレスポンス（Reviewモデル）
@@ -50,48 +135,50 @@ def generate_review(
         3. 会話履歴を構築（システム指示、ユーザー要求、実行コード、結果）
         4. LLMを呼び出してレビューを生成
     """
-    # プロンプトテンプレートを読み込み、システム指示を生成
-    template = load_template(template_file)
-    system_instruction = template.render(
+    messages = _build_messages(
         data_info=data_info,
+        user_request=user_request,
+        data_thread=data_thread,
+        has_results=has_results,
+        max_images=max_images,
         remote_save_dir=remote_save_dir,
+        template_file=template_file,
     )
     
-    # LLMとの会話履歴を構築
-    messages = [
-        {"role": "system", "content": system_instruction},  # システム指示
-        {"role": "user", "content": user_request},  # ユーザーの要求
-        {"role": "assistant", "content": data_thread.code},  # 実行されたコード
-    ]
-    
-    # 結果データがある場合の処理
-    if has_results:
-        # 実行結果をLLMが理解できる形式に変換
-        results = [
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{res['content']}"},
-            }
-            if res["type"] == "png"  # PNG画像の場合、Base64形式で画像URLとして設定
-            else {"type": "text", "text": res["content"]}  # テキストの場合、そのまま設定
-            for res in data_thread.results
-        ]
-        messages.append({"role": "system", "content": results})  # 結果データを追加
-    
-    # 残りのメッセージを追加
-    messages.extend([
-        {"role": "system", "content": f"stdout: {data_thread.stdout}"},  # 標準出力
-        {"role": "system", "content": f"stderr: {data_thread.stderr}"},  # 標準エラー
-        {
-            "role": "user",
-            "content": "実行結果に対するフィードバックを提供してください。",  # レビュー要求
-        },
-    ])
-    
     # LLMを呼び出してレビューを生成
     # Reviewモデルを使用して構造化された出力を取得
     return openai.generate_response(
         messages,
         model=model,
         response_format=Review,
+        temperature=temperature,
+    )
+
+
+async def agenerate_review(
+    data_info: str,
+    user_request: str,
+    data_thread: DataThread,
+    has_results: bool = False,
+    max_images: int = 4,
+    remote_save_dir: str = "outputs/process_id/id",
+    model: str = model,
+    template_file: str = DEFAULT_TEMPLATE_FILE,
+    temperature: float | None = None,
+) -> LLMResponse:
+    """generate_reviewの非同期版（並行して実行されるタスクから呼び出す）"""
+    messages = _build_messages(
+        data_info=data_info,
+        user_request=user_request,
+        data_thread=data_thread,
+        has_results=has_results,
+        max_images=max_images,
+        remote_save_dir=remote_save_dir,
+        template_file=template_file,
+    )
+    return await openai.agenerate_response(
+        messages,
+        model=model,
+        response_format=Review,
+        temperature=temperature,
     )
@@ -0,0 +1,38 @@
+"""
+共有Sandboxモジュール
+
+プロセス内で1つのE2B Sandboxを作成して使い回す機能を提供します。
+Sandboxの起動には数秒かかるため、スクリプトから繰り返し呼び出される処理では
+毎回作成せずに同じSandboxを使います。
+"""
+
+import atexit
+
+from e2b_code_interpreter import Sandbox
+
+_SANDBOX: Sandbox | None = None
+
+
+def get_sandbox() -> Sandbox:
+    """
+    共有のE2B Sandboxを取得する（初回呼び出し時に作成する）
+
+    close_sandboxを呼ばずに終了した場合も、プロセス終了時に破棄する。
+
+    Returns:
+        Sandbox: 共有のE2B Sandboxインスタンス
+    """
+    global _SANDBOX
+    if _SANDBOX is None:
+        _SANDBOX = Sandbox()
+        atexit.register(close_sandbox)
+    return _SANDBOX
+
+
+def close_sandbox() -> None:
+    """共有のE2B Sandboxを破棄する（次にget_sandboxを呼び出した場合は新しく作成する）"""
+    global _SANDBOX
+    if _SANDBOX is not None:
+        sandbox, _SANDBOX = _SANDBOX, None
+        atexit.unregister(close_sandbox)
+        sandbox.kill()
@@ -9,15 +9,35 @@ pandasを使用してデータフレームとして読み込む機能を提供
 利用可能にする役割を担います。
 """
 
-import io
+from typing import BinaryIO
 
 from e2b_code_interpreter import Sandbox
 from e2b_code_interpreter.models import Execution
 
 
+def read_dataframe_code(remote_data_path: str = "/home/data.csv") -> str:
+    """
+    リモート環境のCSVファイルを'df'という変数名のデータフレームとして読み込むコードを返す
+
+    Args:
+        remote_data_path: リモート環境でのファイル保存パス（デフォルト: "/home/data.csv"）
+
+    Returns:
+        str: Sandboxで実行するPythonコード
+    """
+    # 高速なpyarrowエンジンで読み込み、使えない場合（未インストールなど）はCエンジンで読み込む
+    return (
+        "import pandas as pd\n"
+        "try:\n"
+        f"    df = pd.read_csv('{remote_data_path}', engine='pyarrow')\n"
+        "except Exception:\n"
+        f"    df = pd.read_csv('{remote_data_path}', engine='c', low_memory=False, cache_dates=True)\n"
+    )
+
+
 def set_dataframe(
     sandbox: Sandbox,
-    file_object: io.BytesIO,
+    file_object: BinaryIO,
     timeout: int = 1200,
     remote_data_path: str = "/home/data.csv",
 ) -> Execution:
@@ -26,7 +46,7 @@ def set_dataframe(
     
     Args:
         sandbox: E2B Sandboxインスタンス
-        file_object: アップロードするCSVファイルのBytesIOオブジェクト
+        file_object: アップロードするCSVファイル（open(..., "rb")で開いたファイルなど）
         timeout: コード実行のタイムアウト時間（秒、デフォルト: 1200秒）
         remote_data_path: リモート環境でのファイル保存パス（デフォルト: "/home/data.csv"）
         
@@ -41,11 +61,9 @@ def set_dataframe(
     """
     # CSVファイルをリモート環境の指定パスに書き込み
     # file_objectの内容をremote_data_pathに保存
+    # （ファイル全体をメモリ上にコピーせず、開いたファイルからそのまま送信する）
     sandbox.files.write(remote_data_path, file_object)
     
     # pandasを使用してCSVファイルをデータフレームとして読み込み
     # 'df'という変数名でデータフレームを作成し、後続の処理で利用可能にする
-    return sandbox.run_code(
-        f"import pandas as pd; df = pd.read_csv('{remote_data_path}')",
-        timeout=timeout,
-    )
+    return sandbox.run_code(read_dataframe_code(remote_data_path), timeout=timeout)